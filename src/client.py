@@ -0,0 +1,44 @@
+# SPDX-License-Identifier: GPL-2.0
+# Copyright (C) 2020-present Team LibreELEC
+#
+# query and control the settings add-on from scripts, e.g.
+#   python3 client.py get system hostname
+#   python3 client.py update_status
+#   python3 client.py timing on; python3 client.py timing
+
+import json
+import socket
+import sys
+
+SOCKET = '/var/run/service.libreelec.settings.sock'
+
+
+def request(command, *args):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(SOCKET)
+        sock.sendall(f'{json.dumps({"command": command, "args": list(args)})}\n'.encode('utf-8'))
+        with sock.makefile('r', encoding='utf-8') as reply:
+            return json.loads(reply.readline())
+
+
+def main(argv):
+    if not argv:
+        argv = ['help']
+    try:
+        reply = request(*argv)
+    except (OSError, ValueError) as e:
+        print(f'{argv[0]}: {e}', file=sys.stderr)
+        return 2
+    if 'error' in reply:
+        print(reply['error'], file=sys.stderr)
+        return 1
+    result = reply.get('result')
+    if isinstance(result, str):
+        print(result)
+    elif result is not None:
+        print(json.dumps(result, indent=2))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
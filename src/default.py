@@ -4,7 +4,9 @@
 # Copyright (C) 2019-present Team LibreELEC (https://libreelec.tv)
 
 import xbmc
+import shlex
 import socket
+import sys
 import xbmcaddon
 
 __scriptid__ = 'service.libreelec.settings'
@@ -16,7 +18,9 @@ _ = __addon__.getLocalizedString
 try:
     sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     sock.connect('/var/run/service.libreelec.settings.sock')
-    sock.send(bytes('openConfigurationWindow', 'utf-8'))
+    request = ' '.join(['openConfigurationWindow'] + [shlex.quote(arg) for arg in sys.argv[1:2]])
+    sock.send(bytes(f'{request}\n', 'utf-8'))
+    sock.recv(1024)
     sock.close()
 except Exception as e:
     xbmc.executebuiltin(f'Notification("LibreELEC", "{_(32390)}", 5000, "{__media__}/icon.png"')
@@ -0,0 +1,442 @@
+# SPDX-License-Identifier: GPL-2.0
+# Copyright (C) 2020-present Team LibreELEC
+import contextlib
+import fcntl
+import fnmatch
+import glob
+import hashlib
+import json
+import os
+import queue
+import re
+import shutil
+import subprocess
+import tarfile
+import threading
+import zlib
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+BUFSIZE = 1024 * 1024
+QUEUE_SIZE = 8
+GZIP_LEVEL = 6
+XZ_PRESET = 1
+ZSTD_LEVEL = 3
+
+EXTENSIONS = {
+    'none': '.tar',
+    'gzip': '.tar.gz',
+    'xz': '.tar.xz',
+    'zstd': '.tar.zst',
+    }
+# compressions the boot-time restore can extract itself, busybox tar in the
+# initramfs detects gzip and xz but not zstd
+BOOT_MODES = ('none', 'gzip', 'xz')
+ARCHIVE_MASK = '|'.join(f'??????????????{extension}' for extension in EXTENSIONS.values())
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+MANIFEST_VERSION = 1
+FICLONE = 0x40049409
+MANIFEST_EXTENSION = '.manifest.json'
+
+
+def available_modes():
+    modes = ['none', 'gzip']
+    if lzma is not None:
+        modes.append('xz')
+    if shutil.which('zstd'):
+        modes.append('zstd')
+    return modes
+
+
+# xz is far too slow on ARM boxes to be the default, zstd is faster than
+# gzip but its archives have to be decompressed in full before a restore
+def default_mode():
+    return 'gzip'
+
+
+def archive_name(timestamp, mode):
+    return f'{timestamp}{EXTENSIONS.get(mode, ".tar")}'
+
+
+def archive_mode(path):
+    for mode, extension in sorted(EXTENSIONS.items(), key=lambda item: -len(item[1])):
+        if path.endswith(extension):
+            return mode
+    return 'none'
+
+
+def archive_stem(path):
+    return os.path.basename(path).split('.')[0]
+
+
+# the boot-time restore hands the staged file to tar, which detects the
+# compression of BOOT_MODES itself, so every archive is staged under the
+# plain .tar name; other archives are decompressed by stage()
+def staged_name(path):
+    return f'{archive_stem(path)}.tar'
+
+
+def boot_mode(mode):
+    return mode if mode in BOOT_MODES else 'none'
+
+
+# rules are (pattern, include) pairs matched with fnmatch against the full
+# path, the first match decides; user rules from path come before defaults
+def load_rules(path, defaults):
+    rules = []
+    try:
+        with open(path) as rules_file:
+            for line in rules_file:
+                action, _, pattern = line.strip().partition(' ')
+                if action in ('+', '-') and pattern.strip():
+                    rules.append((pattern.strip(), action == '+'))
+    except FileNotFoundError:
+        pass
+    rules += [(pattern, False) for pattern in defaults]
+    return [(pattern, include, re.compile(fnmatch.translate(pattern)).match) for pattern, include in rules]
+
+
+def match_rule(rules, path):
+    for rule in rules:
+        if rule[2](path):
+            return rule
+    return None
+
+
+def format_size(size):
+    for unit in ('B', 'KB', 'MB'):
+        if size < 1024:
+            return f'{size:,.0f} {unit}'
+        size /= 1024
+    return f'{size:,.1f} GB'
+
+
+class _Identity(object):
+
+    def compress(self, data):
+        return data
+
+    def flush(self):
+        return b''
+
+
+# file object handed to tarfile in stream mode: chunks are compressed and
+# written in a worker thread so compression overlaps with reading the next
+# files (zlib and lzma release the GIL while compressing)
+class _ThreadedWriter(object):
+
+    def __init__(self, path, compressor):
+        self.file = open(path, 'wb')
+        self.compressor = compressor
+        self.queue = queue.Queue(QUEUE_SIZE)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while True:
+            data = self.queue.get()
+            if data is None:
+                break
+            if self.error is None:
+                try:
+                    self.file.write(self.compressor.compress(data))
+                except Exception as e:
+                    self.error = e
+        if self.error is None:
+            try:
+                self.file.write(self.compressor.flush())
+            except Exception as e:
+                self.error = e
+
+    def write(self, data):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(bytes(data))
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+        if self.error is not None:
+            raise self.error
+
+
+# zstd is not in the standard library, pipe the stream to the multi-threaded
+# command line tool instead
+class _ProcessWriter(object):
+
+    def __init__(self, path, command):
+        self.process = subprocess.Popen(command + ['-o', path], stdin=subprocess.PIPE)
+
+    def write(self, data):
+        self.process.stdin.write(data)
+
+    def close(self):
+        self.process.stdin.close()
+        if self.process.wait() != 0:
+            raise OSError(f'compressor exited with {self.process.returncode}')
+
+
+def _writer(path, mode):
+    if mode == 'gzip':
+        return _ThreadedWriter(path, zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31))
+    if mode == 'xz' and lzma is not None:
+        return _ThreadedWriter(path, lzma.LZMACompressor(preset=XZ_PRESET))
+    if mode == 'zstd':
+        return _ProcessWriter(path, ['zstd', '-q', '-f', '-T0', f'-{ZSTD_LEVEL}'])
+    return _ThreadedWriter(path, _Identity())
+
+
+@contextlib.contextmanager
+def create(path, mode):
+    writer = _writer(path, mode)
+    try:
+        with tarfile.open(fileobj=writer, mode='w|', bufsize=BUFSIZE) as tar:
+            yield tar
+    finally:
+        writer.close()
+
+
+@contextlib.contextmanager
+def _open(archive):
+    # peek without moving the file offset, zstd reads the descriptor itself
+    magic = os.pread(archive.fileno(), len(ZSTD_MAGIC), 0)
+    if magic != ZSTD_MAGIC:
+        with tarfile.open(fileobj=archive, mode='r|*', bufsize=BUFSIZE) as tar:
+            yield tar
+        return
+    process = subprocess.Popen(['zstd', '-q', '-d', '-c'], stdin=archive, stdout=subprocess.PIPE)
+    try:
+        with tarfile.open(fileobj=process.stdout, mode='r|', bufsize=BUFSIZE) as tar:
+            yield tar
+        # tarfile stops at the end-of-archive blocks, zstd only verifies the
+        # frame checksum once all of it has been decompressed
+        while process.stdout.read(BUFSIZE):
+            pass
+        if process.wait() != 0:
+            raise tarfile.ReadError(f'zstd exited with {process.returncode}')
+    finally:
+        process.stdout.close()
+        process.wait()
+
+
+# open any archive written by create() for reading, tarfile detects gzip and
+# xz itself, zstd is decompressed by the command line tool
+@contextlib.contextmanager
+def open_archive(path):
+    with open(path, 'rb') as archive:
+        with _open(archive) as tar:
+            yield tar
+
+
+# stream every member header without extracting anything: tarfile checks
+# the header checksums, reading through the data checks the compression,
+# member names must stay below the restore root and the file totals must
+# match the manifest when there is one
+def validate(path, progress=None):
+    size = os.path.getsize(path)
+    files = 0
+    total_size = 0
+    with open(path, 'rb') as archive:
+        with _open(archive) as tar:
+            for member in tar:
+                name = member.name
+                if name.startswith('/') or '..' in name.split('/'):
+                    raise ValueError(f'unsafe member {name}')
+                if not (member.isreg() or member.isdir() or member.issym() or member.islnk()):
+                    raise ValueError(f'unsupported member {name}')
+                if member.isreg():
+                    files += 1
+                    total_size += member.size
+                position = os.lseek(archive.fileno(), 0, os.SEEK_CUR)
+                if progress is not None and not progress(position * 100 // max(size, 1), name):
+                    return None
+    manifest = load_manifest(path)
+    if manifest is not None:
+        name = os.path.basename(path)
+        records = [record for record in manifest['files'].values() if record[3] == name and record[2] is not None]
+        if len(records) != files or sum(record[0] for record in records) != total_size:
+            raise ValueError(f'{files} files, {total_size} bytes do not match the manifest')
+    return (files, total_size)
+
+
+# put archive into the restore folder without copying if possible, a hard
+# link or a reflink only needs the archive once on disk; archives the boot
+# restore can not read are decompressed to a plain tar instead
+def stage(source, destination):
+    if not archive_mode(source) in BOOT_MODES:
+        return decompress(source, destination)
+    try:
+        os.link(source, destination)
+        return 'link'
+    except OSError:
+        pass
+    try:
+        with open(source, 'rb') as src, open(destination, 'wb') as dst:
+            fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+        return 'reflink'
+    except OSError:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(destination)
+    return None
+
+
+def decompress(source, destination):
+    try:
+        subprocess.run(['zstd', '-q', '-d', '-f', source, '-o', destination], check=True)
+        return 'decompress'
+    except (OSError, subprocess.CalledProcessError):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(destination)
+    return None
+
+
+def can_stage_without_copy(source, folder):
+    return archive_mode(source) in BOOT_MODES and os.stat(source).st_dev == os.stat(folder).st_dev
+
+
+class _HashingReader(object):
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha256()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.hash.update(data)
+        return data
+
+
+# add a regular file and return the size and mtime_ns it was archived with,
+# which the manifest records as the file may have changed since the scan, and
+# the sha256 of the content, hashed while tarfile copies it so every file is
+# only read once; a further hard link to a file already in the archive is
+# stored without data and has no sha256
+def add_file(tar, path):
+    with open(path, 'rb') as fileobj:
+        mtime = os.fstat(fileobj.fileno()).st_mtime_ns
+        tarinfo = tar.gettarinfo(path, fileobj=fileobj)
+        if tarinfo.islnk():
+            tar.addfile(tarinfo)
+            return (os.fstat(fileobj.fileno()).st_size, mtime, None)
+        reader = _HashingReader(fileobj)
+        tar.addfile(tarinfo, reader)
+    return (tarinfo.size, mtime, reader.hash.hexdigest())
+
+
+# manifest stored next to each archive:
+#   files:   {path: [size, mtime_ns, sha256, archive holding the content]},
+#            sha256 is None for a hard link to another file of that archive
+#   deleted: paths present in the base but gone in this backup
+def manifest_path(archive_path):
+    return os.path.join(os.path.dirname(archive_path), f'{archive_stem(archive_path)}{MANIFEST_EXTENSION}')
+
+
+def new_manifest(archive_path, base=None):
+    return {
+        'version': MANIFEST_VERSION,
+        'archive': os.path.basename(archive_path),
+        'base': base['archive'] if base else None,
+        'files': {},
+        'deleted': [],
+        }
+
+
+def load_manifest(archive_path):
+    try:
+        with open(manifest_path(archive_path)) as manifest_file:
+            manifest = json.load(manifest_file)
+    except (OSError, ValueError):
+        return None
+    if manifest.get('version') != MANIFEST_VERSION:
+        return None
+    return manifest
+
+
+def write_manifest(archive_path, manifest):
+    path = manifest_path(archive_path)
+    with open(f'{path}.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(f'{path}.tmp', path)
+
+
+def remove_manifest(archive_path):
+    try:
+        os.remove(manifest_path(archive_path))
+    except FileNotFoundError:
+        pass
+
+
+# newest backup in folder that can serve as base for an incremental one
+def latest_manifest(folder):
+    for path in sorted(glob.glob(os.path.join(folder, f'??????????????{MANIFEST_EXTENSION}')), reverse=True):
+        with contextlib.suppress(OSError, ValueError):
+            with open(path) as manifest_file:
+                manifest = json.load(manifest_file)
+            if manifest.get('version') == MANIFEST_VERSION and \
+                    os.path.isfile(os.path.join(folder, manifest['archive'])):
+                return manifest
+    return None
+
+
+# (files, uncompressed bytes) restored from archive_path and its chain
+def manifest_totals(archive_path):
+    manifest = load_manifest(archive_path)
+    if manifest is None:
+        return None
+    records = [record for record in manifest['files'].values() if record[2] is not None]
+    return (len(records), sum(record[0] for record in records))
+
+
+# upper bound for a plain tar of files: a header and padding for every file
+def tar_size(files, size):
+    return size + files * 2 * tarfile.BLOCKSIZE + tarfile.RECORDSIZE
+
+
+def is_changed(manifest, path, size, mtime):
+    record = manifest['files'].get(path)
+    return record is None or record[0] != size or record[1] != mtime
+
+
+# archives needed to restore archive_path, oldest first
+def chain(archive_path):
+    folder = os.path.dirname(archive_path)
+    archives = [archive_path]
+    manifest = load_manifest(archive_path)
+    while manifest and manifest['base']:
+        base_path = os.path.join(folder, manifest['base'])
+        if base_path in archives or not os.path.isfile(base_path):
+            raise FileNotFoundError(base_path)
+        archives.insert(0, base_path)
+        manifest = load_manifest(base_path)
+        if manifest is None:
+            raise FileNotFoundError(manifest_path(base_path))
+    return archives
+
+
+# replay an incremental chain into one full archive: every file is taken
+# from the archive holding its latest content, hard links from the archive
+# that holds them next to their target, files deleted along the chain are
+# dropped, directories, symlinks and mount points come from the newest
+# archive
+def merge_chain(archives, destination, mode, progress=None):
+    manifest = load_manifest(archives[-1])
+    with create(destination, mode) as merged:
+        for index, archive in enumerate(archives):
+            name = os.path.basename(archive)
+            newest = index == len(archives) - 1
+            with open_archive(archive) as tar:
+                for member in tar:
+                    if progress is not None and not progress(index, member.name):
+                        return False
+                    if member.isfile() or member.islnk():
+                        record = manifest['files'].get(f'/{member.name}')
+                        if record is not None and record[3] == name:
+                            merged.addfile(member, tar.extractfile(member) if member.isfile() else None)
+                    elif newest:
+                        merged.addfile(member)
+    return True
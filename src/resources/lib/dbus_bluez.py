@@ -0,0 +1,62 @@
+# SPDX-License-Identifier: GPL-2.0
+# Copyright (C) 2020-present Team LibreELEC
+import dbus_utils
+import ravel
+
+BUS_NAME = 'org.bluez'
+INTERFACE_DEVICE = 'org.bluez.Device1'
+INTERFACE_OBJECT_MANAGER = 'org.freedesktop.DBus.ObjectManager'
+INTERFACE_PROPERTIES = 'org.freedesktop.DBus.Properties'
+PATH_BLUEZ = '/org/bluez'
+
+
+class Listener(object):
+
+    def listen(self):
+        dbus_utils.BUS.listen_signal(
+            interface=INTERFACE_OBJECT_MANAGER,
+            fallback=True,
+            func=self._on_interfaces_added,
+            path='/',
+            name='InterfacesAdded')
+        dbus_utils.BUS.listen_signal(
+            interface=INTERFACE_OBJECT_MANAGER,
+            fallback=True,
+            func=self._on_interfaces_removed,
+            path='/',
+            name='InterfacesRemoved')
+        dbus_utils.BUS.listen_signal(
+            interface=INTERFACE_PROPERTIES,
+            fallback=True,
+            func=self._on_properties_changed,
+            path=PATH_BLUEZ,
+            name='PropertiesChanged')
+
+    @ravel.signal(name='InterfacesAdded', in_signature='oa{sa{sv}}', arg_keys=('path', 'interfaces'))
+    async def _on_interfaces_added(self, path, interfaces):
+        interfaces = dbus_utils.convert_from_dbussy(interfaces)
+        await self.on_interfaces_added(path, interfaces)
+
+    @ravel.signal(name='InterfacesRemoved', in_signature='oas', arg_keys=('path', 'interfaces'))
+    async def _on_interfaces_removed(self, path, interfaces):
+        interfaces = dbus_utils.convert_from_dbussy(interfaces)
+        await self.on_interfaces_removed(path, interfaces)
+
+    @ravel.signal(name='PropertiesChanged', in_signature='sa{sv}as', arg_keys=('interface', 'changed', 'invalidated'), path_keyword='path')
+    async def _on_properties_changed(self, interface, changed, invalidated, path):
+        changed = dbus_utils.convert_from_dbussy(changed)
+        invalidated = dbus_utils.convert_from_dbussy(invalidated)
+        await self.on_properties_changed(interface, changed, invalidated, path)
+
+    async def on_interfaces_added(self, path, interfaces):
+        pass
+
+    async def on_interfaces_removed(self, path, interfaces):
+        pass
+
+    async def on_properties_changed(self, interface, changed, invalidated, path):
+        pass
+
+
+def manager_get_managed_objects():
+    return dbus_utils.call_method(BUS_NAME, '/', INTERFACE_OBJECT_MANAGER, 'GetManagedObjects')
@@ -0,0 +1,91 @@
+# SPDX-License-Identifier: GPL-2.0
+# Copyright (C) 2020-present Team LibreELEC
+import asyncio
+import dbus_utils
+import ravel
+
+BUS_NAME = 'org.freedesktop.systemd1'
+INTERFACE_MANAGER = 'org.freedesktop.systemd1.Manager'
+PATH_SYSTEMD = '/org/freedesktop/systemd1'
+JOB_TIMEOUT = 30
+
+
+# resolves the jobs queued here from systemd's JobRemoved signal, which is
+# sent for every job on the system once subscribed; a job can end before
+# the RestartUnit reply is processed, so other finished jobs are only kept
+# while a call is waiting for its reply
+class JobListener(object):
+
+    def __init__(self):
+        self.jobs = {}
+        self.finished = {}
+        self.queuing = 0
+        self.subscribed = False
+
+    async def subscribe(self):
+        if self.subscribed:
+            return
+        dbus_utils.BUS.listen_signal(
+            interface=INTERFACE_MANAGER,
+            fallback=False,
+            func=self._on_job_removed,
+            path=PATH_SYSTEMD,
+            name='JobRemoved')
+        await dbus_utils.call_async_method(BUS_NAME, PATH_SYSTEMD, INTERFACE_MANAGER, 'Subscribe')
+        self.subscribed = True
+
+    @ravel.signal(name='JobRemoved', in_signature='uoss', arg_keys=('id', 'job', 'unit', 'result'))
+    async def _on_job_removed(self, id, job, unit, result):
+        future = self.jobs.pop(str(job), None)
+        if future is not None:
+            if not future.done():
+                future.set_result(str(result))
+        elif self.queuing:
+            self.finished[str(job)] = str(result)
+
+    async def run(self, method, unit, timeout):
+        self.queuing += 1
+        try:
+            job = str(await dbus_utils.call_async_method(BUS_NAME, PATH_SYSTEMD, INTERFACE_MANAGER, method, unit, 'replace'))
+        finally:
+            self.queuing -= 1
+        result = self.finished.pop(job, None)
+        if not self.queuing:
+            self.finished.clear()
+        if result is not None:
+            return result
+        future = asyncio.get_running_loop().create_future()
+        self.jobs[job] = future
+        try:
+            return await asyncio.wait_for(future, timeout)
+        finally:
+            self.jobs.pop(job, None)
+
+
+LISTENER = JobListener()
+
+
+async def _unit_job(method, unit, timeout):
+    try:
+        return await LISTENER.run(method, unit, timeout)
+    except asyncio.TimeoutError:
+        return 'timeout'
+    except Exception as e:
+        return repr(e)
+
+
+async def _units_jobs(method, units, timeout):
+    await LISTENER.subscribe()
+    results = await asyncio.gather(*(_unit_job(method, unit, timeout) for unit in units))
+    return dict(zip(units, results))
+
+
+# queue the jobs of all units at once and return a concurrent future with
+# the systemd result of every unit ('done', 'failed', 'timeout', ...)
+def restart_units(units, timeout=JOB_TIMEOUT):
+    return asyncio.run_coroutine_threadsafe(_units_jobs('RestartUnit', units, timeout), dbus_utils.LOOP)
+
+
+def stop_units(units, timeout=JOB_TIMEOUT):
+    return asyncio.run_coroutine_threadsafe(_units_jobs('StopUnit', units, timeout), dbus_utils.LOOP)
+
@@ -68,12 +68,22 @@ system = {
     'KEYBOARD_INFO': '/usr/share/X11/xkb/rules/base.xml',
     'UDEV_KEYBOARD_INFO': f'{CONFIG_CACHE}/xkb/layout',
     'NOX_KEYBOARD_INFO': '/usr/lib/keymaps',
+    'KEYBOARD_CACHE': f'{CONFIG_CACHE}/libreelec/keyboard_layouts.json',
     'BACKUP_DIRS': [
         XBMC_USER_HOME,
         USER_CONFIG,
         CONFIG_CACHE,
         '/storage/.ssh',
         ],
+    'BACKUP_EXCLUDE': [
+        f'{XBMC_USER_HOME}/userdata/Thumbnails',
+        f'{XBMC_USER_HOME}/userdata/Database/Textures*.db',
+        f'{XBMC_USER_HOME}/temp',
+        f'{XBMC_USER_HOME}/addons/packages',
+        f'{XBMC_USER_HOME}/addons/temp',
+        f'{CONFIG_CACHE}/update_staging',
+        ],
+    'BACKUP_RULES_FILE': f'{USER_CONFIG}/backup-rules.conf',
     'BACKUP_DESTINATION': '/storage/backup/',
     'RESTORE_DIR': '/storage/.restore/',
     }
@@ -83,8 +93,18 @@ updates = {
     'UPDATE_REQUEST_URL': 'https://update.libreelec.tv/updates.php',
     'UPDATE_DOWNLOAD_URL': 'http://%s.libreelec.tv/%s',
     'LOCAL_UPDATE_DIR': '/storage/.update/',
+    'STAGING_UPDATE_DIR': f'{CONFIG_CACHE}/update_staging/',
+    'UPDATE_CHECK_INTERVAL': 21600,
+    'UPDATE_CHECK_JITTER': 1800,
+    'UPDATE_PENDING_INTERVAL': 3600,
+    'UPDATE_RETRY_MIN': 300,
+    'UPDATE_RETRY_MAX': 3600,
 
     'RPI_FLASHING_TRIGGER': '/storage/.rpi_flash_firmware',
+    'RPI_EEPROM_CACHE': f'{CONFIG_CACHE}/libreelec/rpi_eeprom_state.json',
+    'RPI_EEPROM_FIRMWARE': [
+        '/lib/firmware/raspberrypi/bootloader',
+        ],
     }
 
 about = {'ENABLED': True}
@@ -100,3 +120,9 @@ _services = {
     'crond': ['cron.service'],
     'iptables': ['iptables.service'],
     }
+
+# options a unit depends on, units not listed here are restarted on any
+# change of their service options
+_services_options = {
+    'nmbd.service': ['SAMBA_WORKGROUP'],
+    }
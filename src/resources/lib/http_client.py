@@ -0,0 +1,205 @@
+# SPDX-License-Identifier: GPL-2.0
+# Copyright (C) 2020-present Team LibreELEC
+import base64
+import gzip
+import http.client
+import log
+import threading
+import time
+import urllib.parse
+import urllib.request
+
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 30
+RETRIES = 3
+BACKOFF = 0.5
+MAX_REDIRECTS = 5
+MAX_IDLE = 2
+USER_AGENT = 'service.libreelec.settings'
+
+_POOL = {}
+_POOL_LOCK = threading.Lock()
+
+
+class HTTPError(Exception):
+
+    def __init__(self, url, code, reason=''):
+        super().__init__(f'HTTP {code} {reason} ({url})')
+        self.url = url
+        self.code = code
+        self.reason = reason
+
+
+class Response(object):
+
+    def __init__(self, url, key, connection, response, started):
+        self.url = url
+        self.key = key
+        self.connection = connection
+        self.response = response
+        self.status = response.status
+        self.started = started
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt=None):
+        return self.response.read(amt)
+
+    def close(self):
+        if self.connection is None:
+            return
+        # a fully read keep-alive response leaves the connection reusable
+        if self.response.isclosed() and not self.response.will_close:
+            _release(self.key, self.connection)
+        else:
+            self.response.close()
+            self.connection.close()
+        self.connection = None
+        log.log(f'{self.url} {self.status} {time.time() - self.started:.3f}s', log.DEBUG)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+# the http_proxy / https_proxy / no_proxy environment as urllib reads it,
+# returns (host, port, headers) of the proxy for key or None
+def _proxy(key):
+    scheme, host, port = key
+    proxy = urllib.request.getproxies().get(scheme)
+    if not proxy or urllib.request.proxy_bypass(host):
+        return None
+    if not '://' in proxy:
+        proxy = f'http://{proxy}'
+    parts = urllib.parse.urlsplit(proxy)
+    headers = {}
+    if parts.username:
+        credentials = f'{urllib.parse.unquote(parts.username)}:{urllib.parse.unquote(parts.password or "")}'
+        headers['Proxy-Authorization'] = f'Basic {base64.b64encode(credentials.encode()).decode()}'
+    return (parts.hostname, parts.port or 8080, headers)
+
+
+def _acquire(key):
+    with _POOL_LOCK:
+        idle = _POOL.get(key)
+        if idle:
+            return (idle.pop(), True)
+    scheme, host, port = key
+    proxy = _proxy(key)
+    if scheme == 'https' and proxy:
+        connection = http.client.HTTPSConnection(proxy[0], proxy[1], timeout=CONNECT_TIMEOUT)
+        connection.set_tunnel(host, port, headers=proxy[2])
+    elif scheme == 'https':
+        connection = http.client.HTTPSConnection(host, port, timeout=CONNECT_TIMEOUT)
+    elif proxy:
+        connection = http.client.HTTPConnection(proxy[0], proxy[1], timeout=CONNECT_TIMEOUT)
+    else:
+        connection = http.client.HTTPConnection(host, port, timeout=CONNECT_TIMEOUT)
+    connection.connect()
+    connection.sock.settimeout(READ_TIMEOUT)
+    return (connection, False)
+
+
+def _release(key, connection):
+    with _POOL_LOCK:
+        idle = _POOL.setdefault(key, [])
+        if len(idle) < MAX_IDLE:
+            idle.append(connection)
+            return
+    connection.close()
+
+
+def _acquire_new(key):
+    with _POOL_LOCK:
+        for connection in _POOL.pop(key, []):
+            connection.close()
+    return _acquire(key)
+
+
+def close_all():
+    with _POOL_LOCK:
+        for idle in _POOL.values():
+            for connection in idle:
+                connection.close()
+        _POOL.clear()
+
+
+def _split(url):
+    parts = urllib.parse.urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'https' else 80)
+    path = parts.path or '/'
+    if parts.query:
+        path = f'{path}?{parts.query}'
+    return ((parts.scheme, parts.hostname, port), path)
+
+
+def _request_once(url, headers):
+    key, path = _split(url)
+    # a plain http proxy gets the absolute url instead of a tunnel
+    proxy = _proxy(key) if key[0] == 'http' else None
+    if proxy:
+        path = url.split('#')[0]
+        headers = dict(headers, **proxy[2])
+    started = time.time()
+    connection, reused = _acquire(key)
+    try:
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+    except (OSError, http.client.HTTPException):
+        connection.close()
+        if not reused:
+            raise
+        # the server dropped an idle keep-alive connection, try a fresh one
+        connection, reused = _acquire_new(key)
+        connection.request('GET', path, headers=headers)
+        response = connection.getresponse()
+    return Response(url, key, connection, response, started)
+
+
+# GET url and return an open Response, following redirects and retrying
+# connection errors and 5xx answers with exponential backoff
+def request(url, headers=None, offset=0):
+    headers = dict(headers or {})
+    headers.setdefault('User-Agent', USER_AGENT)
+    if offset > 0:
+        headers['Range'] = f'bytes={offset}-'
+    for redirect in range(MAX_REDIRECTS + 1):
+        for attempt in range(RETRIES):
+            try:
+                response = _request_once(url, headers)
+            except (OSError, http.client.HTTPException) as e:
+                if attempt == RETRIES - 1:
+                    raise
+                log.log(f'{url} attempt {attempt + 1} failed: {repr(e)}', log.DEBUG)
+                time.sleep(BACKOFF * 2 ** attempt)
+                continue
+            if response.status >= 500 and attempt < RETRIES - 1:
+                response.read()
+                response.close()
+                time.sleep(BACKOFF * 2 ** attempt)
+                continue
+            break
+        if response.status in (301, 302, 303, 307, 308):
+            location = response.getheader('Location')
+            response.read()
+            response.close()
+            url = urllib.parse.urljoin(url, location)
+            continue
+        if response.status >= 400:
+            reason = response.response.reason
+            response.read()
+            response.close()
+            raise HTTPError(url, response.status, reason)
+        return response
+    raise HTTPError(url, response.status, 'Too many redirects')
+
+
+def get(url):
+    with request(url, {'Accept-Encoding': 'gzip'}) as response:
+        content = response.read()
+        if response.getheader('Content-Encoding', '') == 'gzip':
+            content = gzip.decompress(content)
+    return content
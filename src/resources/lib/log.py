@@ -1,7 +1,13 @@
 # SPDX-License-Identifier: GPL-2.0
 # Copyright (C) 2020-present Team LibreELEC
-import pprint
+import collections
+import functools
+import json
+import os
+import reprlib
 import sys
+import threading
+import time
 import traceback
 
 DEBUG = 0
@@ -13,33 +19,205 @@ NONE = 5
 
 _DEFAULT = DEBUG
 _HEADER = 'SETTINGS: '
+_LEVEL_TTL = 10
+_MAX_LENGTH = 1024
+_TIMING_SAMPLES = 256
+_REPEAT_INTERVAL = 60
+_REPEAT_KEYS = 256
+
+# the LibreELEC DEBUG switch for oe.dbg_log debug lines, read once
+DEBUG_ENV = os.environ.get('DEBUG', 'no') != 'no'
+
+TIMING_FILE = f'{os.environ.get("CONFIG_CACHE", "/storage/.cache")}/libreelec/settings_timing.json'
 
 
 try:
     import xbmc
     def _log(message, level=_DEFAULT):
         xbmc.log(message, level)
+    def _debug_enabled():
+        return xbmc.getCondVisibility('System.GetBool(debug.showloginfo)')
 except ModuleNotFoundError:
     def _log(message, level=_DEFAULT):
         print(message)
+    def _debug_enabled():
+        return True
+
+
+# Kodi always writes INFO and above, DEBUG only with debug logging enabled;
+# the setting is looked up at most every _LEVEL_TTL seconds
+_debug = [False, 0]
+
+
+def enabled(level):
+    if level > DEBUG:
+        return True
+    now = time.monotonic()
+    if now >= _debug[1]:
+        try:
+            _debug[0] = bool(_debug_enabled())
+        except Exception:
+            _debug[0] = True
+        _debug[1] = now + _LEVEL_TTL
+    return _debug[0]
+
+
+# large structs and D-Bus dicts are cut down while they are formatted, not
+# after, so logging them costs the same as logging a small value
+_repr = reprlib.Repr()
+_repr.maxlevel = 4
+_repr.maxdict = 16
+_repr.maxlist = 16
+_repr.maxtuple = 16
+_repr.maxset = 16
+_repr.maxstring = 256
+_repr.maxother = 256
+
+
+def format_value(value):
+    text = _repr.repr(value)
+    if len(text) > _MAX_LENGTH:
+        text = f'{text[:_MAX_LENGTH]}...'
+    return text
+
+
+# wall-clock and CPU time of every call of a decorated function, kept per
+# qualified name over the last _TIMING_SAMPLES calls; None while disabled,
+# enabled with SETTINGS_TIMING in the environment or enable_timing()
+_timings = {} if os.environ.get('SETTINGS_TIMING', 'no') != 'no' else None
+_timings_lock = threading.Lock()
+
+
+class _Timing(object):
+
+    def __init__(self):
+        self.count = 0
+        self.max = 0.0
+        self.wall = collections.deque(maxlen=_TIMING_SAMPLES)
+        self.cpu = collections.deque(maxlen=_TIMING_SAMPLES)
+
+    def add(self, wall, cpu):
+        self.count += 1
+        self.max = max(self.max, wall)
+        self.wall.append(wall)
+        self.cpu.append(cpu)
+
+    def summary(self):
+        wall = sorted(self.wall)
+        cpu = sorted(self.cpu)
+        return {
+            'count': self.count,
+            'p50': wall[len(wall) // 2],
+            'p95': wall[len(wall) * 95 // 100],
+            'max': self.max,
+            'cpu_p50': cpu[len(cpu) // 2],
+            'cpu_p95': cpu[len(cpu) * 95 // 100],
+            }
+
+
+def enable_timing(enable=True):
+    global _timings
+    with _timings_lock:
+        if not enable:
+            _timings = None
+        elif _timings is None:
+            _timings = {}
+
+
+def _add_timing(name, wall, cpu):
+    with _timings_lock:
+        if _timings is not None:
+            if not name in _timings:
+                _timings[name] = _Timing()
+            _timings[name].add(wall, cpu)
+
+
+def timings():
+    with _timings_lock:
+        if _timings is None:
+            return {}
+        return {name: timing.summary() for name, timing in _timings.items()}
+
+
+# write the histograms sorted by their slowest p95, returns the file name or
+# None when timing is disabled
+def dump_timings(file_name=TIMING_FILE):
+    summary = timings()
+    if not summary:
+        return None
+    os.makedirs(os.path.dirname(file_name), exist_ok=True)
+    with open(f'{file_name}.tmp', 'w') as timing_file:
+        json.dump(dict(sorted(summary.items(), key=lambda item: -item[1]['p95'])), timing_file, indent=1)
+    os.replace(f'{file_name}.tmp', file_name)
+    return file_name
+
+
+# log() and oe.dbg_log() write through here: a message identical to one
+# written less than _REPEAT_INTERVAL seconds ago is only counted, the count
+# is added the next time the message is written; returns whether it was
+_repeats = {}
+_repeats_lock = threading.Lock()
+
+
+def write(message, level=_DEFAULT):
+    now = time.monotonic()
+    key = (message, level)
+    with _repeats_lock:
+        repeat = _repeats.get(key)
+        if repeat is not None and now - repeat[0] < _REPEAT_INTERVAL:
+            repeat[1] += 1
+            return False
+        if len(_repeats) >= _REPEAT_KEYS:
+            for old_key in [old_key for old_key, old in _repeats.items() if now - old[0] >= _REPEAT_INTERVAL]:
+                del _repeats[old_key]
+            if len(_repeats) >= _REPEAT_KEYS:
+                _repeats.clear()
+        _repeats[key] = [now, 0]
+    if repeat is not None and repeat[1]:
+        message = f'{message} (repeated {repeat[1]} times)'
+    _log(message, level)
+    return True
+
+
+# the traceback of the exception being handled, if there is one
+def write_exception(level=ERROR):
+    if sys.exc_info()[0] is not None:
+        _log(traceback.format_exc(), level)
 
 
 def log(message, level=_DEFAULT):
-    _log(f'{_HEADER}{sys._getframe().f_back.f_code.co_name} # {message}', level)
+    if not enabled(level):
+        return
+    write(f'{_HEADER}{sys._getframe().f_back.f_code.co_name} # {message}', level)
 
 
 def log_function(level=_DEFAULT):
     def _log_function_1(function):
-        header = f'{_HEADER}{function.__qualname__} '
+        name = function.__qualname__
+        header = f'{_HEADER}{name} '
+        @functools.wraps(function)
         def _log_function_2(*args, **kwargs):
             try:
-                _log(f'{header}-', level)
-                for arg in args:
-                    _log(f'{header}< {pprint.pformat(arg)}', level)
-                for key, value in kwargs.items():
-                    _log(f'{header}< {key}={pprint.pformat(value)}', level)
-                result = function(*args, **kwargs)
-                _log(f'{header}> {pprint.pformat(result)}', level)
+                log_call = enabled(level)
+                if not log_call and _timings is None:
+                    return function(*args, **kwargs)
+                if log_call:
+                    _log(f'{header}-', level)
+                    for arg in args:
+                        _log(f'{header}< {format_value(arg)}', level)
+                    for key, value in kwargs.items():
+                        _log(f'{header}< {key}={format_value(value)}', level)
+                if _timings is None:
+                    result = function(*args, **kwargs)
+                else:
+                    wall = time.perf_counter()
+                    cpu = time.thread_time()
+                    try:
+                        result = function(*args, **kwargs)
+                    finally:
+                        _add_timing(name, time.perf_counter() - wall, time.thread_time() - cpu)
+                if log_call:
+                    _log(f'{header}> {format_value(result)}', level)
                 return result
             except Exception as e:
                 _log(f'{header}# {repr(e)}', ERROR)
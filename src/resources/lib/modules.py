@@ -3,9 +3,21 @@
 import defaults
 import log
 import oe
+import re
+import threading
+import time
+import xbmcgui
+from concurrent.futures import ThreadPoolExecutor
 
 class Module(object):
 
+    INIT_DEPENDS = ()
+    START_DEPENDS = ()
+    START_TIMEOUT = 30
+    # actions known to work without the window, only their settings can be
+    # changed with apply_setting
+    SOCKET_ACTIONS = ()
+
     @log.log_function()
     def __init__(self):
         name = self.__class__.__name__
@@ -14,6 +26,8 @@ class Module(object):
             for key, value in settings.items():
                 setattr(self, key, value)
                 log.log(f'{name}.{key}={value}')
+        self.loaded_values = set()
+        self.loaded_values_lock = threading.RLock()
 
     def do_init(self):
         pass
@@ -26,3 +40,175 @@ class Module(object):
 
     def stop_service(self):
         pass
+
+    # struct categories can name a 'loader' method that fills their values;
+    # loaders run when the page is first shown and are memoized until
+    # invalidate_values(), a loader shared by several categories runs once
+    def load_category(self, category):
+        loader = self.struct[category].get('loader')
+        if loader is None or loader in self.loaded_values:
+            return
+        with self.loaded_values_lock:
+            if loader in self.loaded_values:
+                return
+            getattr(self, loader)()
+            self.loaded_values.add(loader)
+
+    def load_page(self):
+        for category in getattr(self, 'struct', {}):
+            self.load_category(category)
+
+    def invalidate_values(self, *loaders):
+        with self.loaded_values_lock:
+            if loaders:
+                self.loaded_values.difference_update(loaders)
+            else:
+                self.loaded_values.clear()
+
+    # changes a setting without the window the way a click on it does: the
+    # value is put on a list item that is passed to the setting's action,
+    # undecorated so that a failing action raises instead of being logged
+    def apply_setting(self, setting, value, category=None):
+        struct = getattr(self, 'struct', {})
+        categories = [name for name in struct if setting in struct[name].get('settings', {})]
+        if category is not None:
+            categories = [name for name in categories if name == category]
+        if not categories:
+            raise ValueError(f'unknown setting {setting}')
+        if len(categories) > 1:
+            raise ValueError(f'{setting} is in {", ".join(categories)}, name the category')
+        category = categories[0]
+        entry = struct[category]['settings'][setting]
+        action = entry.get('action')
+        if entry.get('type') == 'button' or action not in self.SOCKET_ACTIONS:
+            raise ValueError(f'{setting} cannot be changed outside the window')
+        self.load_category(category)
+        value = str(value)
+        if entry['type'] == 'bool' and value not in ('0', '1'):
+            raise ValueError(f'{setting} must be 0 or 1')
+        if entry['type'] == 'num' and not value.isdigit():
+            raise ValueError(f'{setting} must be a number')
+        if entry['type'] == 'multivalue' and entry.get('values') and value not in entry['values']:
+            raise ValueError(f'{setting} must be one of {", ".join(entry["values"])}')
+        if 'validate' in entry and not re.search(entry['validate'], value):
+            raise ValueError(f'{value} is not a valid {setting}')
+        listItem = xbmcgui.ListItem(offscreen=True)
+        listItem.setProperty('category', category)
+        listItem.setProperty('entry', setting)
+        listItem.setProperty('typ', entry['type'])
+        listItem.setProperty('value', value)
+        function = getattr(type(self), action)
+        getattr(function, '__wrapped__', function)(self, listItem=listItem)
+
+
+# runs one method of several modules on a bounded pool of worker threads,
+# a module is started once the modules named in its depends attribute are
+# ready and given up on after the seconds in its timeout attribute; every
+# module gets a ready event and its run time is recorded
+class Runner(object):
+
+    def __init__(self, modules, method, depends, timeout=None, workers=4):
+        self.modules = modules
+        self.method = method
+        self.timeout = timeout
+        self.workers = workers
+        self.depends = {}
+        for name, module in modules.items():
+            self.depends[name] = [depend for depend in getattr(module, depends, ()) if depend in modules]
+        self.ready = {name: threading.Event() for name in modules}
+        self.finished = set()
+        self.running = {}
+        self.durations = {}
+        self.errors = {}
+        self.timed_out = set()
+        self.changed = threading.Event()
+        self.all_finished = threading.Event()
+        self.lock = threading.Lock()
+
+    # modules on or behind a dependency cycle could never start, they lose
+    # the dependencies that can not be resolved
+    def break_cycles(self):
+        resolved = set()
+        remaining = dict(self.depends)
+        while True:
+            ready = [name for name, depends in remaining.items() if all(depend in resolved for depend in depends)]
+            if not ready:
+                break
+            for name in ready:
+                resolved.add(name)
+                del remaining[name]
+        if remaining:
+            log.log(f'{self.method}: unresolvable dependencies {list(remaining)}', log.ERROR)
+            for name in remaining:
+                self.depends[name] = [depend for depend in self.depends[name] if depend in resolved]
+
+    def start(self):
+        self.started = time.time()
+        self.break_cycles()
+        self.pending = dict(self.depends)
+        self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix=self.method)
+        self.submit_ready()
+
+    def submit_ready(self):
+        with self.lock:
+            for name, depends in list(self.pending.items()):
+                if all(self.is_done(depend) for depend in depends):
+                    del self.pending[name]
+                    self.executor.submit(self.run, name)
+            if not self.pending:
+                self.executor.shutdown(wait=False)
+            if len(self.finished) == len(self.modules):
+                self.all_finished.set()
+
+    def run(self, name):
+        started = time.time()
+        self.running[name] = started
+        try:
+            getattr(self.modules[name], self.method)()
+        except Exception as e:
+            self.errors[name] = e
+            log.log(f'{name}.{self.method}: {repr(e)}', log.ERROR)
+        finally:
+            self.durations[name] = time.time() - started
+            self.finished.add(name)
+            self.submit_ready()
+            self.ready[name].set()
+            self.changed.set()
+
+    def is_done(self, name):
+        return name in self.finished or name in self.timed_out
+
+    # wait for every module, a module running longer than the timeout it
+    # declares is given up on so the modules depending on it can start;
+    # all_finished is only set once the modules given up on returned too
+    def join(self):
+        while True:
+            self.changed.clear()
+            now = time.time()
+            waiting = [name for name in self.modules if not self.is_done(name)]
+            if not waiting:
+                return
+            for name in waiting:
+                limit = getattr(self.modules[name], self.timeout, None) if self.timeout else None
+                if name in self.running and limit and now - self.running[name] > limit:
+                    self.timed_out.add(name)
+                    log.log(f'{name}.{self.method} still running after {limit}s', log.WARNING)
+            self.submit_ready()
+            self.changed.wait(1)
+
+    def wait(self, name, timeout=None):
+        if not name in self.ready:
+            return True
+        return self.ready[name].wait(timeout)
+
+    def is_ready(self, name):
+        return not name in self.ready or self.ready[name].is_set()
+
+    def report(self):
+        lines = [f'{self.method}: {time.time() - self.started:.3f}s']
+        for name in sorted(self.durations, key=self.durations.get, reverse=True):
+            state = 'error' if name in self.errors else 'ok'
+            lines.append(f'  {name}: {self.durations[name]:.3f}s {state}')
+        for name in self.timed_out - self.durations.keys():
+            lines.append(f'  {name}: {time.time() - self.running[name]:.3f}s timeout')
+        return '\n'.join(lines)
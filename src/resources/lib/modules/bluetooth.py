@@ -14,10 +14,17 @@ import dbus
 import dbus.service
 import threading
 import oeWindows
+import dbus_bluez
+
+# the devices bluez reported last, kept current by the Listener whether or
+# not the connections page is shown
+_devices = {}
+_devices_lock = threading.Lock()
 
 
 class bluetooth(modules.Module):
 
+    START_DEPENDS = ('services',)
     menu = {'6': {
         'name': 32331,
         'menuLoader': 'menu_connections',
@@ -43,8 +50,16 @@ class bluetooth(modules.Module):
 
     @log.log_function()
     def start_service(self):
+        self.listener = Listener()
+        self.listener.listen()
         if 'org.bluez' in oe.dbusSystemBus.list_names():
             self.init_adapter()
+            devices = {}
+            for path, interfaces in dbus_bluez.manager_get_managed_objects().items():
+                if dbus_bluez.INTERFACE_DEVICE in interfaces:
+                    devices[path] = interfaces[dbus_bluez.INTERFACE_DEVICE]
+            with _devices_lock:
+                _devices.update(devices)
 
     @log.log_function()
     def stop_service(self):
@@ -132,6 +147,22 @@ class bluetooth(modules.Module):
         dbusBluezManager = None
         return devices
 
+    @log.log_function()
+    def get_devices_state(self):
+        with _devices_lock:
+            known = [(path, dict(properties)) for path, properties in _devices.items()]
+        devices = []
+        for path, properties in known:
+            device = {'path': str(path)}
+            for name in ('Name', 'Address', 'Icon'):
+                if name in properties:
+                    device[name] = str(properties[name])
+            for name in ('Paired', 'Trusted', 'Connected'):
+                if name in properties:
+                    device[name] = bool(properties[name])
+            devices.append(device)
+        return devices
+
     @log.log_function()
     def init_device(self, listItem=None):
         if listItem is None:
@@ -668,6 +699,31 @@ class bluetooth(modules.Module):
                     itf = None
 
 
+####################################################################
+## Bluetooth Listener class
+####################################################################
+
+class Listener(dbus_bluez.Listener):
+
+    async def on_interfaces_added(self, path, interfaces):
+        if dbus_bluez.INTERFACE_DEVICE in interfaces:
+            with _devices_lock:
+                _devices[path] = interfaces[dbus_bluez.INTERFACE_DEVICE]
+
+    async def on_interfaces_removed(self, path, interfaces):
+        if dbus_bluez.INTERFACE_DEVICE in interfaces:
+            with _devices_lock:
+                _devices.pop(path, None)
+
+    async def on_properties_changed(self, interface, changed, invalidated, path):
+        if interface == dbus_bluez.INTERFACE_DEVICE:
+            with _devices_lock:
+                if path in _devices:
+                    _devices[path].update(changed)
+                    for name in invalidated:
+                        _devices[path].pop(name, None)
+
+
 ####################################################################
 ## Bluetooth Agent class
 ####################################################################
@@ -16,9 +16,36 @@ import string
 import config
 import regdom
 import dbus_connman
+import dbus_utils
 import log
+import threading
 from dbussy import DBusError
 
+# the services connman reported last, in its order, kept current by the
+# Listener whether or not the connections page is shown
+SERVICE_PROPERTIES = ('Name', 'Type', 'State', 'Strength', 'Favorite', 'Security', 'IPv4', 'Ethernet')
+_services = {}
+_services_lock = threading.Lock()
+
+
+# ServicesChanged lists every service in order, with only the changed
+# properties of the services already known
+def _update_services(services, removed=()):
+    with _services_lock:
+        known = dict(_services)
+        for path in removed:
+            known.pop(path, None)
+        _services.clear()
+        for path, properties in services:
+            _services[path] = known.get(path, {})
+            _services[path].update(properties)
+
+
+def _update_service(path, name, value):
+    with _services_lock:
+        if path in _services:
+            _services[path][name] = value
+
 ####################################################################
 ## Connection properties class
 ####################################################################
@@ -427,6 +454,7 @@ class connmanService(object):
 
 class connman(modules.Module):
 
+    SOCKET_ACTIONS = ('custom_regdom', 'init_netfilter', 'set_network_wait')
     ENABLED = False
     CONNMAN_DAEMON = None
     WAIT_CONF_FILE = None
@@ -784,6 +812,18 @@ class connman(modules.Module):
             if rebuildList == 1:
                 self.listItems[dbusServicePath] = oe.winOeMain.addConfigItem(apName, dictProperties, oe.listObject['netlist'])
 
+    @log.log_function()
+    def get_services_state(self):
+        services = []
+        with _services_lock:
+            for path, properties in _services.items():
+                service = {'path': path}
+                for name in SERVICE_PROPERTIES:
+                    if name in properties:
+                        service[name] = properties[name]
+                services.append(service)
+        return services
+
     @log.log_function()
     def menu_loader(self, menuItem=None):
         if menuItem == None:
@@ -1009,6 +1049,8 @@ class connman(modules.Module):
         self.agent = Agent.register_agent()
         self.listener = Listener(self)
         self.listener.listen()
+        _update_services([(path, dbus_utils.convert_from_dbussy(properties))
+                          for path, properties in dbus_connman.manager_get_services()])
 
     @log.log_function()
     def stop_service(self):
@@ -1107,6 +1149,7 @@ class Listener(dbus_connman.Listener):
 
     @log.log_function()
     async def on_property_changed(self, name, value, path):
+        _update_service(path, name, value)
         if self.parent.visible:
             self.updateGui(name, value, path)
 
@@ -1121,6 +1164,7 @@ class Listener(dbus_connman.Listener):
 
     @log.log_function()
     async def on_services_changed(self, services, removed):
+        _update_services(services, removed)
         if self.parent.visible:
             self.parent.menu_connections(None, services, removed, force=True)
 
@@ -15,6 +15,9 @@ xbmcDialog = xbmcgui.Dialog()
 
 class services(modules.Module):
 
+    START_DEPENDS = ('system',)
+    SOCKET_ACTIONS = ('initialize_samba', 'initialize_ssh', 'initialize_avahi', 'initialize_cron',
+                      'initialize_bluetooth', 'initialize_obex', 'idle_timeout')
     ENABLED = False
     SAMBA_NMDB = None
     SAMBA_SMDB = None
@@ -45,6 +48,7 @@ class services(modules.Module):
             'samba': {
                 'order': 1,
                 'name': 32200,
+                'loader': 'load_values',
                 'not_supported': [],
                 'settings': {
                     'samba_autostart': {
@@ -154,6 +158,7 @@ class services(modules.Module):
             'ssh': {
                 'order': 2,
                 'name': 32201,
+                'loader': 'load_values',
                 'not_supported': [],
                 'settings': {
                     'ssh_autostart': {
@@ -193,6 +198,7 @@ class services(modules.Module):
             'avahi': {
                 'order': 3,
                 'name': 32207,
+                'loader': 'load_values',
                 'not_supported': [],
                 'settings': {'avahi_autostart': {
                     'order': 1,
@@ -206,6 +212,7 @@ class services(modules.Module):
             'cron': {
                 'order': 4,
                 'name': 32319,
+                'loader': 'load_values',
                 'not_supported': [],
                 'settings': {'cron_autostart': {
                     'order': 1,
@@ -219,6 +226,7 @@ class services(modules.Module):
             'bluez': {
                 'order': 6,
                 'name': 32331,
+                'loader': 'load_values',
                 'not_supported': [],
                 'settings': {
                     'enabled': {
@@ -280,7 +288,7 @@ class services(modules.Module):
 
     @log.log_function()
     def start_service(self):
-        self.load_values()
+        self.load_page()
         self.initialize_samba(service=1)
         self.initialize_ssh(service=1)
         self.initialize_avahi(service=1)
@@ -289,7 +297,7 @@ class services(modules.Module):
 
     @log.log_function()
     def do_init(self):
-        self.load_values()
+        self.invalidate_values()
 
     @log.log_function()
     def set_value(self, listItem):
@@ -362,6 +370,27 @@ class services(modules.Module):
             else:
                 self.struct['bluez']['hidden'] = 'true'
 
+    # set_service returns the pending systemd jobs, the results are logged
+    # and shown once systemd has finished them so the window is not blocked
+    def report_jobs(self, jobs):
+        if jobs is None:
+            return
+
+        def done(future):
+            try:
+                results = future.result()
+            except Exception as e:
+                log.log(f'systemd jobs: {repr(e)}', log.ERROR)
+                return
+            log.log(f'systemd jobs: {results}', log.INFO)
+            failed = [f'{unit}: {result}' for unit, result in results.items() if result != 'done']
+            if failed:
+                oe.notify(oe._(32415), ', '.join(failed))
+            else:
+                oe.notify(', '.join(results), oe._(32414))
+
+        jobs.add_done_callback(done)
+
     @log.log_function()
     def initialize_samba(self, **kwargs):
         if 'listItem' in kwargs:
@@ -392,7 +421,7 @@ class services(modules.Module):
             state = 0
             self.struct['samba']['settings']['samba_username']['hidden'] = True
             self.struct['samba']['settings']['samba_password']['hidden'] = True
-        oe.set_service('samba', options, state)
+        self.report_jobs(oe.set_service('samba', options, state))
 
     @log.log_function()
     def initialize_ssh(self, **kwargs):
@@ -410,7 +439,7 @@ class services(modules.Module):
             options['SSHD_DISABLE_PW_AUTH'] = val
         else:
             state = 0
-        oe.set_service('sshd', options, state)
+        self.report_jobs(oe.set_service('sshd', options, state))
 
     @log.log_function()
     def initialize_avahi(self, **kwargs):
@@ -421,7 +450,7 @@ class services(modules.Module):
             state = 1
         else:
             state = 0
-        oe.set_service('avahi', options, state)
+        self.report_jobs(oe.set_service('avahi', options, state))
 
     @log.log_function()
     def initialize_cron(self, **kwargs):
@@ -432,7 +461,7 @@ class services(modules.Module):
             state = 1
         else:
             state = 0
-        oe.set_service('crond', options, state)
+        self.report_jobs(oe.set_service('crond', options, state))
 
     @log.log_function()
     def initialize_bluetooth(self, **kwargs):
@@ -449,7 +478,7 @@ class services(modules.Module):
             state = 0
             self.struct['bluez']['settings']['obex_enabled']['hidden'] = True
             self.struct['bluez']['settings']['obex_root']['hidden'] = True
-        oe.set_service('bluez', options, state)
+        self.report_jobs(oe.set_service('bluez', options, state))
 
     @log.log_function()
     def initialize_obex(self, **kwargs):
@@ -461,7 +490,7 @@ class services(modules.Module):
             options['OBEXD_ROOT'] = self.struct['bluez']['settings']['obex_root']['value']
         else:
             state = 0
-        oe.set_service('obexd', options, state)
+        self.report_jobs(oe.set_service('obexd', options, state))
 
     @log.log_function()
     def idle_timeout(self, **kwargs):
@@ -3,22 +3,31 @@
 # Copyright (C) 2013 Lutz Fiebach (lufie@openelec.tv)
 # Copyright (C) 2019-present Team LibreELEC (https://libreelec.tv)
 
+import backup
+import errno
 import log
 import modules
 import oe
 import os
 import re
 import glob
+import shutil
+import json
 import xbmc
 import xbmcgui
-import tarfile
 import oeWindows
-from xml.dom import minidom
+from xml.etree import ElementTree
 
 xbmcDialog = xbmcgui.Dialog()
 
+BACKUP_FILE = 0
+BACKUP_DIR = 1
+BACKUP_LINK = 2
+BACKUP_MOUNT = 3
+
 class system(modules.Module):
 
+    SOCKET_ACTIONS = ('set_value', 'set_hostname')
     ENABLED = False
     KERNEL_CMD = None
     XBMC_RESET_FILE = None
@@ -26,7 +35,10 @@ class system(modules.Module):
     KEYBOARD_INFO = None
     UDEV_KEYBOARD_INFO = None
     NOX_KEYBOARD_INFO = None
+    KEYBOARD_CACHE = None
     BACKUP_DIRS = None
+    BACKUP_EXCLUDE = None
+    BACKUP_RULES_FILE = None
     BACKUP_DESTINATION = None
     RESTORE_DIR = None
     SET_CLOCK_CMD = None
@@ -47,6 +59,7 @@ class system(modules.Module):
             'ident': {
                 'order': 1,
                 'name': 32189,
+                'loader': 'load_ident_values',
                 'settings': {'hostname': {
                     'order': 1,
                     'name': 32190,
@@ -60,6 +73,7 @@ class system(modules.Module):
             'keyboard': {
                 'order': 2,
                 'name': 32009,
+                'loader': 'load_keyboard_values',
                 'settings': {
                     'KeyboardLayout1': {
                         'order': 1,
@@ -111,6 +125,7 @@ class system(modules.Module):
             'pinlock': {
                 'order': 3,
                 'name': 32192,
+                'loader': 'load_pinlock_values',
                 'settings': {
                     'pinlock_enable': {
                         'order': 1,
@@ -138,6 +153,7 @@ class system(modules.Module):
             'backup': {
                 'order': 7,
                 'name': 32371,
+                'loader': 'load_backup_values',
                 'settings': {
                     'backup': {
                         'name': 32372,
@@ -155,6 +171,40 @@ class system(modules.Module):
                         'InfoText': 723,
                         'order': 2,
                         },
+                    'BackupCompression': {
+                        'name': 32404,
+                        'value': 'gzip',
+                        'action': 'set_value',
+                        'type': 'multivalue',
+                        'values': ['none', 'gzip'],
+                        'InfoText': 32405,
+                        'order': 3,
+                        },
+                    'BackupType': {
+                        'name': 32406,
+                        'value': 'full',
+                        'action': 'set_value',
+                        'type': 'multivalue',
+                        'values': ['full', 'incremental'],
+                        'InfoText': 32407,
+                        'order': 4,
+                        },
+                    'BackupExcludeCaches': {
+                        'name': 32409,
+                        'value': '1',
+                        'action': 'set_value',
+                        'type': 'bool',
+                        'InfoText': 32410,
+                        'order': 5,
+                        },
+                    'BackupEstimate': {
+                        'name': 32411,
+                        'value': '0',
+                        'action': 'do_backup_estimate',
+                        'type': 'button',
+                        'InfoText': 32412,
+                        'order': 6,
+                        },
                     },
                 },
             'reset': {
@@ -206,7 +256,8 @@ class system(modules.Module):
     @log.log_function()
     def start_service(self):
         self.is_service = True
-        self.load_values()
+        self.load_category('ident')
+        self.load_category('keyboard')
         self.set_hostname()
         self.set_keyboard_layout()
         self.set_hw_clock()
@@ -219,7 +270,10 @@ class system(modules.Module):
 
     @log.log_function()
     def load_values(self):
-        # Keyboard Layout
+        self.load_page()
+
+    @log.log_function()
+    def load_keyboard_values(self):
         (
             arrLayouts,
             arrTypes,
@@ -253,13 +307,31 @@ class system(modules.Module):
             self.struct['keyboard']['settings']['KeyboardVariant1']['hidden'] = 'true'
             self.struct['keyboard']['settings']['KeyboardVariant2']['hidden'] = 'true'
             self.nox_keyboard_layouts = True
-        # Hostname
+
+    @log.log_function()
+    def load_ident_values(self):
         value = oe.read_setting('system', 'hostname')
         if not value is None:
             self.struct['ident']['settings']['hostname']['value'] = value
         else:
             self.struct['ident']['settings']['hostname']['value'] = oe.DISTRIBUTION
-        # PIN Lock
+
+    @log.log_function()
+    def load_backup_values(self):
+        self.struct['backup']['settings']['BackupCompression']['values'] = backup.available_modes()
+        value = oe.read_setting('system', 'BackupCompression')
+        if value not in backup.available_modes():
+            value = backup.default_mode()
+        self.struct['backup']['settings']['BackupCompression']['value'] = value
+        value = oe.read_setting('system', 'BackupType')
+        if not value is None:
+            self.struct['backup']['settings']['BackupType']['value'] = value
+        value = oe.read_setting('system', 'BackupExcludeCaches')
+        if not value is None:
+            self.struct['backup']['settings']['BackupExcludeCaches']['value'] = value
+
+    @log.log_function()
+    def load_pinlock_values(self):
         self.struct['pinlock']['settings']['pinlock_enable']['value'] = '1' if oe.PIN.isEnabled() else '0'
 
     @log.log_function()
@@ -319,90 +391,147 @@ class system(modules.Module):
     def set_hostname(self, listItem=None):
         if not listItem == None:
             self.set_value(listItem)
-        if not self.struct['ident']['settings']['hostname']['value'] is None and not self.struct['ident']['settings']['hostname']['value'] \
-            == '':
-            log.log(self.struct['ident']['settings']['hostname']['value'], log.INFO)
-            hostname = open('/proc/sys/kernel/hostname', 'w')
-            hostname.write(self.struct['ident']['settings']['hostname']['value'])
-            hostname.close()
-            hostname = open(f'{oe.CONFIG_CACHE}/hostname', 'w')
-            hostname.write(self.struct['ident']['settings']['hostname']['value'])
-            hostname.close()
-            hosts = open('/etc/hosts', 'w')
-            user_hosts_file = f"{os.environ['HOME']}/.config/hosts.conf"
-            if os.path.isfile(user_hosts_file):
-                user_hosts = open(user_hosts_file, 'r')
-                hosts.write(user_hosts.read())
-                user_hosts.close()
-            hosts.write(f"127.0.0.1\tlocalhost {self.struct['ident']['settings']['hostname']['value']}\n")
-            hosts.write(f"::1\tlocalhost ip6-localhost ip6-loopback {self.struct['ident']['settings']['hostname']['value']}\n")
-            hosts.close()
+        hostname = self.struct['ident']['settings']['hostname']['value']
+        if not hostname is None and not hostname == '':
+            log.log(hostname, log.INFO)
+            if oe.load_file('/proc/sys/kernel/hostname') != hostname:
+                with open('/proc/sys/kernel/hostname', 'w') as hostname_file:
+                    hostname_file.write(hostname)
+            if oe.load_file(f'{oe.CONFIG_CACHE}/hostname') != hostname:
+                with oe.atomic_write(f'{oe.CONFIG_CACHE}/hostname') as hostname_file:
+                    hostname_file.write(hostname)
+            self.set_hosts(hostname)
         else:
             log.log('Is empty', log.INFO)
 
+    # /etc/hosts is the user hosts.conf followed by the localhost entries,
+    # both are streamed and only written when they differ from the file
+    @log.log_function()
+    def set_hosts(self, hostname):
+        user_hosts_file = f"{os.environ['HOME']}/.config/hosts.conf"
+        localhost = f'127.0.0.1\tlocalhost {hostname}\n::1\tlocalhost ip6-localhost ip6-loopback {hostname}\n'
+        if not os.path.isfile(user_hosts_file):
+            user_hosts_file = None
+        if self.hosts_match('/etc/hosts', user_hosts_file, localhost):
+            return
+        log.log('updating /etc/hosts', log.INFO)
+        with oe.atomic_write('/etc/hosts') as hosts:
+            if user_hosts_file:
+                with open(user_hosts_file, 'r') as user_hosts:
+                    shutil.copyfileobj(user_hosts, hosts)
+            hosts.write(localhost)
+
+    def hosts_match(self, hosts_file, user_hosts_file, localhost):
+        try:
+            with open(hosts_file, 'r') as hosts:
+                if user_hosts_file:
+                    with open(user_hosts_file, 'r') as user_hosts:
+                        while True:
+                            chunk = user_hosts.read(65536)
+                            if not chunk:
+                                break
+                            if hosts.read(len(chunk)) != chunk:
+                                return False
+                return hosts.read(len(localhost) + 1) == localhost
+        except OSError:
+            return False
+
     @log.log_function()
     def get_keyboard_layouts(self):
-        arrLayouts = []
-        arrVariants = {}
-        arrTypes = []
         if os.path.exists(self.NOX_KEYBOARD_INFO):
-            for layout in glob.glob(f'{self.NOX_KEYBOARD_INFO}/*/*.bmap'):
-                if os.path.isfile(layout):
-                    arrLayouts.append(layout.split('/')[-1].split('.')[0])
-            arrLayouts.sort()
-            arrTypes = None
+            key = ['nox', self.get_nox_keyboard_mtime()]
+            parser = self.parse_nox_keyboard_layouts
         elif os.path.exists(self.KEYBOARD_INFO):
-            objXmlFile = open(self.KEYBOARD_INFO, 'r', encoding='utf-8')
-            strXmlText = objXmlFile.read()
-            objXmlFile.close()
-            xml_conf = minidom.parseString(strXmlText)
-            for xml_layout in xml_conf.getElementsByTagName('layout'):
-                for subnode_1 in xml_layout.childNodes:
-                    if subnode_1.nodeName == 'configItem':
-                        for subnode_2 in subnode_1.childNodes:
-                            if subnode_2.nodeName == 'name':
-                                if hasattr(subnode_2.firstChild, 'nodeValue'):
-                                    value = subnode_2.firstChild.nodeValue
-                            if subnode_2.nodeName == 'description':
-                                if hasattr(subnode_2.firstChild, 'nodeValue'):
-                                    arrLayouts.append(subnode_2.firstChild.nodeValue + ':' + value)
-                    if subnode_1.nodeName == 'variantList':
-                        arrVariants[value] = [':']
-                        for subnode_vl in subnode_1.childNodes:
-                            if subnode_vl.nodeName == 'variant':
-                                for subnode_v in subnode_vl.childNodes:
-                                    if subnode_v.nodeName == 'configItem':
-                                        for subnode_ci in subnode_v.childNodes:
-                                            if subnode_ci.nodeName == 'name':
-                                                if hasattr(subnode_ci.firstChild, 'nodeValue'):
-                                                    vvalue = subnode_ci.firstChild.nodeValue.replace(',', '')
-                                            if subnode_ci.nodeName == 'description':
-                                                if hasattr(subnode_ci.firstChild, 'nodeValue'):
-                                                    try:
-                                                        arrVariants[value].append(subnode_ci.firstChild.nodeValue + ':' + vvalue)
-                                                    except:
-                                                        pass
-            for xml_layout in xml_conf.getElementsByTagName('model'):
-                for subnode_1 in xml_layout.childNodes:
-                    if subnode_1.nodeName == 'configItem':
-                        for subnode_2 in subnode_1.childNodes:
-                            if subnode_2.nodeName == 'name':
-                                if hasattr(subnode_2.firstChild, 'nodeValue'):
-                                    value = subnode_2.firstChild.nodeValue
-                            if subnode_2.nodeName == 'description':
-                                if hasattr(subnode_2.firstChild, 'nodeValue'):
-                                    arrTypes.append(subnode_2.firstChild.nodeValue + ':' + value)
-            arrLayouts.sort()
-            arrTypes.sort()
+            key = ['xkb', os.stat(self.KEYBOARD_INFO).st_mtime_ns]
+            parser = self.parse_xkb_keyboard_layouts
         else:
             log.log('No keyboard layouts found)')
             return (None, None, None)
+        cache = self.load_keyboard_cache()
+        if cache is None or cache['key'] != key:
+            arrLayouts, arrTypes, arrVariants = parser()
+            cache = {
+                'key': key,
+                'layouts': arrLayouts,
+                'types': arrTypes,
+                'variants': arrVariants,
+                }
+            self.write_keyboard_cache(cache)
         return (
-            arrLayouts,
-            arrTypes,
-            arrVariants,
+            cache['layouts'],
+            cache['types'],
+            cache['variants'],
             )
 
+    # a new .bmap changes the mtime of its keymap folder
+    def get_nox_keyboard_mtime(self):
+        mtime = os.stat(self.NOX_KEYBOARD_INFO).st_mtime_ns
+        with os.scandir(self.NOX_KEYBOARD_INFO) as items:
+            for item in items:
+                if item.is_dir():
+                    mtime = max(mtime, item.stat().st_mtime_ns)
+        return mtime
+
+    def load_keyboard_cache(self):
+        try:
+            with open(self.KEYBOARD_CACHE, 'r') as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+    def write_keyboard_cache(self, cache):
+        try:
+            os.makedirs(os.path.dirname(self.KEYBOARD_CACHE), exist_ok=True)
+            with open(f'{self.KEYBOARD_CACHE}.tmp', 'w') as cache_file:
+                json.dump(cache, cache_file)
+            os.replace(f'{self.KEYBOARD_CACHE}.tmp', self.KEYBOARD_CACHE)
+        except OSError as e:
+            log.log(f'{self.KEYBOARD_CACHE}: {repr(e)}', log.WARNING)
+
+    @log.log_function()
+    def parse_nox_keyboard_layouts(self):
+        arrLayouts = []
+        for layout in glob.glob(f'{self.NOX_KEYBOARD_INFO}/*/*.bmap'):
+            if os.path.isfile(layout):
+                arrLayouts.append(layout.split('/')[-1].split('.')[0])
+        arrLayouts.sort()
+        return (arrLayouts, None, {})
+
+    # stream base.xml, every layout and model element is dropped as soon as
+    # it has been read
+    @log.log_function()
+    def parse_xkb_keyboard_layouts(self):
+        arrLayouts = []
+        arrVariants = {}
+        arrTypes = []
+        for event, element in ElementTree.iterparse(self.KEYBOARD_INFO):
+            if element.tag == 'layout':
+                value = element.findtext('configItem/name')
+                description = element.findtext('configItem/description')
+                if value is None:
+                    element.clear()
+                    continue
+                if description is not None:
+                    arrLayouts.append(f'{description}:{value}')
+                variants = element.find('variantList')
+                if variants is not None:
+                    arrVariants[value] = [':']
+                    for variant in variants.iterfind('variant/configItem'):
+                        vvalue = variant.findtext('name')
+                        vdescription = variant.findtext('description')
+                        if vvalue is not None and vdescription is not None:
+                            arrVariants[value].append(f'{vdescription}:{vvalue.replace(",", "")}')
+                element.clear()
+            elif element.tag == 'model':
+                value = element.findtext('configItem/name')
+                description = element.findtext('configItem/description')
+                if value is not None and description is not None:
+                    arrTypes.append(f'{description}:{value}')
+                element.clear()
+        arrLayouts.sort()
+        arrTypes.sort()
+        return (arrLayouts, arrTypes, arrVariants)
+
     @log.log_function()
     def set_hw_clock(self):
         oe.execute(f'{self.SET_CLOCK_CMD} 2>/dev/null')
@@ -434,46 +563,96 @@ class system(modules.Module):
 
     @log.log_function()
     def do_backup(self, listItem=None):
-        try:
-            self.total_backup_size = 1
-            self.done_backup_size = 1
+        bckDir = xbmcDialog.browse( 0,
+                                    oe._(32371),
+                                    'files',
+                                    '',
+                                    False,
+                                    False,
+                                    self.BACKUP_DESTINATION )
+
+        if bckDir and os.path.exists(bckDir):
+            backup_dlg = xbmcgui.DialogProgress()
+            backup_dlg.create('LibreELEC', oe._(32375))
+            def progress(percent, text):
+                backup_dlg.update(int(percent), text)
+                return not backup_dlg.iscanceled()
             try:
-                for directory in self.BACKUP_DIRS:
-                    self.get_folder_size(directory)
-            except:
-                pass
-            bckDir = xbmcDialog.browse( 0,
-                                        oe._(32371),
-                                        'files',
-                                        '',
-                                        False,
-                                        False,
-                                        self.BACKUP_DESTINATION )
-
-            if bckDir and os.path.exists(bckDir):
-                # free space check
-                try:
-                    folder_stat = os.statvfs(bckDir)
-                    free_space = folder_stat.f_frsize * folder_stat.f_bavail
-                    if self.total_backup_size > free_space:
-                        txt = oe.split_dialog_text(oe._(32379))
-                        answer = xbmcDialog.ok('Backup', f'{txt[0]}\n{txt[1]}\n{txt[2]}')
-                        return 0
-                except:
-                    pass
-                self.backup_dlg = xbmcgui.DialogProgress()
-                self.backup_dlg.create('LibreELEC', oe._(32375))
-                if not os.path.exists(self.BACKUP_DESTINATION):
-                    os.makedirs(self.BACKUP_DESTINATION)
-                self.backup_file = oe.timestamp() + '.tar'
-                tar = tarfile.open(bckDir + self.backup_file, 'w')
-                for directory in self.BACKUP_DIRS:
-                    self.tar_add_folder(tar, directory)
-                tar.close()
-                self.backup_dlg.close()
-                del self.backup_dlg
-        finally:
-            self.backup_dlg.close()
+                self.write_backup(bckDir, progress)
+            except OSError as e:
+                if e.errno != errno.ENOSPC:
+                    raise
+                backup_dlg.close()
+                txt = oe.split_dialog_text(oe._(32379))
+                answer = xbmcDialog.ok('Backup', f'{txt[0]}\n{txt[1]}\n{txt[2]}')
+            finally:
+                backup_dlg.close()
+
+    # write a backup of BACKUP_DIRS into folder with the saved backup settings,
+    # progress(percent, text) returns False to cancel; returns the archive
+    # path or None when cancelled, raises ENOSPC before writing anything
+    def write_backup(self, folder, progress=None):
+        self.load_category('backup')
+        entries, total_size = self.scan_backup_dirs(self.BACKUP_DIRS, self.get_backup_rules())
+        base = None
+        if self.struct['backup']['settings']['BackupType']['value'] == 'incremental':
+            base = backup.latest_manifest(folder)
+        unchanged = {}
+        if base:
+            entries, total_size, unchanged = self.filter_unchanged(entries, base)
+        folder_stat = os.statvfs(folder)
+        if total_size > folder_stat.f_frsize * folder_stat.f_bavail:
+            raise OSError(errno.ENOSPC, os.strerror(errno.ENOSPC), folder)
+        mode = self.struct['backup']['settings']['BackupCompression']['value']
+        backup_path = os.path.join(folder, backup.archive_name(oe.timestamp(), mode))
+        manifest = backup.new_manifest(backup_path, base)
+        with backup.create(backup_path, mode) as tar:
+            completed = self.tar_add_entries(tar, entries, total_size, manifest, progress)
+        if not completed:
+            os.remove(backup_path)
+            return None
+        if base:
+            manifest['files'].update(unchanged)
+            manifest['deleted'] = [path for path in base['files'] if not path in manifest['files']]
+        backup.write_manifest(backup_path, manifest)
+        return backup_path
+
+    # keep only files changed since the base backup, unchanged files are
+    # referenced from the archive that holds them
+    @log.log_function()
+    def filter_unchanged(self, entries, base):
+        changed = []
+        total_size = 0
+        unchanged = {}
+        for entry in entries:
+            path, kind, size, mtime = entry
+            if kind == BACKUP_FILE and not backup.is_changed(base, path, size, mtime):
+                unchanged[path] = base['files'][path]
+                continue
+            changed.append(entry)
+            total_size += size
+        log.log(f'{len(entries) - len(changed)} unchanged entries since {base["archive"]}', log.INFO)
+        return (changed, total_size, unchanged)
+
+    @log.log_function()
+    def get_backup_rules(self):
+        defaults = []
+        if self.struct['backup']['settings']['BackupExcludeCaches']['value'] == '1':
+            defaults = self.BACKUP_EXCLUDE
+        return backup.load_rules(self.BACKUP_RULES_FILE, defaults)
+
+    # dry run of the backup scan, also walks the excluded folders to report
+    # what every exclude rule saves
+    @log.log_function()
+    def do_backup_estimate(self, listItem=None):
+        rules = self.get_backup_rules()
+        saved = {rule[0]: [0, 0] for rule in rules if not rule[1]}
+        entries, total_size = self.scan_backup_dirs(self.BACKUP_DIRS, rules, saved)
+        files = sum(1 for entry in entries if entry[1] == BACKUP_FILE)
+        lines = [f'{backup.format_size(total_size)} in {files:,} files', '']
+        for pattern, (size, count) in saved.items():
+            lines.append(f'{pattern}: -{backup.format_size(size)} in {count:,} files')
+        xbmcDialog.textviewer(oe._(32411), '\n'.join(lines))
 
     @log.log_function()
     def do_restore(self, listItem=None):
@@ -481,26 +660,57 @@ class system(modules.Module):
             restore_file_path = xbmcDialog.browse( 1,
                                                    oe._(32373),
                                                    'files',
-                                                   '??????????????.tar',
+                                                   backup.ARCHIVE_MASK,
                                                    False,
                                                    False,
                                                    self.BACKUP_DESTINATION )
             # Do nothing if the dialog is cancelled - path will be the backup destination
             if not os.path.isfile(restore_file_path):
                 return
-            restore_file_name = restore_file_path.split('/')[-1]
+            restore_file_name = backup.staged_name(restore_file_path)
+            try:
+                archives = backup.chain(restore_file_path)
+            except FileNotFoundError as e:
+                log.log(f'incomplete backup chain, missing {e}', log.ERROR)
+                xbmcDialog.ok('Restore', oe._(32408))
+                return
             if os.path.exists(self.RESTORE_DIR):
                 oe.execute('rm -rf %s' % self.RESTORE_DIR)
             os.makedirs(self.RESTORE_DIR)
+            if len(archives) == 1:
+                totals = self.validate_backup(restore_file_path)
+            else:
+                totals = backup.manifest_totals(archives[-1])
+            if totals is None:
+                oe.execute(f'rm -rf {self.RESTORE_DIR}')
+                return
             folder_stat = os.statvfs(self.RESTORE_DIR)
-            file_size = os.path.getsize(restore_file_path)
+            file_size = sum(os.path.getsize(archive) for archive in archives)
             free_space = folder_stat.f_frsize * folder_stat.f_bavail
-            if free_space > file_size * 2:
-                if os.path.exists(self.RESTORE_DIR + restore_file_name):
-                    os.remove(self.RESTORE_DIR + restore_file_name)
-                if oe.copy_file(restore_file_path, self.RESTORE_DIR + restore_file_name) != None:
+            # room to extract the uncompressed content, plus the staged archive:
+            # nothing when it is linked, a plain tar when it is decompressed or
+            # merged uncompressed, otherwise a copy of the compressed archives
+            files, restore_size = totals
+            staged_mode = backup.boot_mode(backup.archive_mode(archives[-1]))
+            if (len(archives) > 1 or staged_mode != backup.archive_mode(restore_file_path)) and staged_mode == 'none':
+                staged_size = backup.tar_size(files, restore_size)
+            elif len(archives) > 1 or not backup.can_stage_without_copy(restore_file_path, self.RESTORE_DIR):
+                staged_size = file_size
+            else:
+                staged_size = 0
+            required_space = restore_size + staged_size
+            log.log(f'restore needs {restore_size} + {staged_size} bytes, {free_space} free', log.INFO)
+            if free_space > required_space:
+                restore_file = self.RESTORE_DIR + restore_file_name
+                if len(archives) > 1:
+                    if self.merge_backup_chain(archives, restore_file):
+                        copy_success = 1
+                elif backup.stage(restore_file_path, restore_file):
                     copy_success = 1
-                else:
+                elif backup.archive_mode(restore_file_path) in backup.BOOT_MODES and \
+                        oe.copy_file(restore_file_path, restore_file) != None:
+                    copy_success = 1
+                if copy_success == 0:
                     oe.execute(f'rm -rf {self.RESTORE_DIR}')
             else:
                 txt = oe.split_dialog_text(oe._(32379))
@@ -517,6 +727,43 @@ class system(modules.Module):
                     log.log('User Abort!')
                     oe.execute(f'rm -rf {self.RESTORE_DIR}')
 
+    @log.log_function()
+    def validate_backup(self, path):
+        restore_dlg = xbmcgui.DialogProgress()
+        restore_dlg.create('Restore', oe._(32373))
+        try:
+            def progress(percent, member):
+                restore_dlg.update(int(percent), member)
+                return not restore_dlg.iscanceled()
+            result = backup.validate(path, progress)
+            if result is not None:
+                log.log(f'{path}: {result[0]} files, {result[1]} bytes', log.INFO)
+            return result
+        except Exception as e:
+            log.log(f'{path} is damaged: {repr(e)}', log.ERROR)
+            restore_dlg.close()
+            xbmcDialog.ok('Restore', oe._(32413))
+            return None
+        finally:
+            restore_dlg.close()
+
+    # the boot-time restore extracts a single archive, so an incremental chain
+    # is replayed into one full archive first
+    @log.log_function()
+    def merge_backup_chain(self, archives, destination):
+        restore_dlg = xbmcgui.DialogProgress()
+        restore_dlg.create('Restore', oe._(32373))
+        try:
+            def progress(index, member):
+                restore_dlg.update(index * 100 // len(archives), f'{os.path.basename(archives[index])}\n{member}')
+                return not restore_dlg.iscanceled()
+            return backup.merge_chain(archives, destination, backup.boot_mode(backup.archive_mode(archives[-1])), progress)
+        except Exception as e:
+            log.log(f'merging {archives[-1]} failed: {repr(e)}', log.ERROR)
+            return False
+        finally:
+            restore_dlg.close()
+
     @log.log_function()
     def do_send_system_logs(self, listItem=None):
         self.do_send_logs('/usr/bin/pastekodi')
@@ -540,48 +787,82 @@ class system(modules.Module):
                 xbmcDialog.ok('Failed paste', 'Failed to paste log files, try again')
 
     @log.log_function()
-    def tar_add_folder(self, tar, folder):
+    def tar_add_entries(self, tar, entries, total_size, manifest, progress=None):
+        done_size = 0
+        for path, kind, size, mtime in entries:
+            if kind != BACKUP_FILE:
+                tar.add(path, recursive=False)
+                continue
+            try:
+                size, mtime, digest = backup.add_file(tar, path)
+            except FileNotFoundError:
+                continue
+            manifest['files'][path] = [size, mtime, digest, manifest['archive']]
+            done_size += size
+            if progress is not None and not progress(done_size * 100 // max(total_size, 1), f'{os.path.dirname(path)}\n{os.path.basename(path)}'):
+                return False
+        return True
+
+    @log.log_function()
+    def scan_backup_dirs(self, folders, rules=(), saved=None):
+        entries = []
+        total_size = 0
+        for folder in folders:
+            try:
+                device = os.stat(folder).st_dev
+            except OSError:
+                continue
+            total_size += self.scan_backup_folder(folder, device, entries, rules, saved)
+        log.log(f'{len(entries)} entries, {total_size} bytes to backup', log.INFO)
+        return (entries, total_size)
+
+    # single os.scandir pass collecting the tar manifest and the total size;
+    # symlinks and mount points are stored but not followed, empty directories
+    # are stored so they are recreated on restore. Excluded items are skipped
+    # without descending, unless saved asks for the size of every rule
+    def scan_backup_folder(self, folder, device, entries, rules=(), saved=None):
+        total_size = 0
         try:
-            for item in os.listdir(folder):
-                if item == self.backup_file:
+            with os.scandir(folder) as items:
+                items = list(items)
+        except OSError as e:
+            log.log(f'{folder}: {repr(e)}', log.WARNING)
+            return 0
+        for item in items:
+            try:
+                rule = backup.match_rule(rules, item.path) if rules else None
+                if rule and not rule[1]:
+                    if saved is not None:
+                        self.count_excluded(item, device, saved[rule[0]])
                     continue
-                if self.backup_dlg.iscanceled():
-                    try:
-                        os.remove(self.BACKUP_DESTINATION + self.backup_file)
-                    except:
-                        pass
-                    return 0
-                itempath = os.path.join(folder, item)
-                if os.path.islink(itempath):
-                    tar.add(itempath)
-                elif os.path.ismount(itempath):
-                    tar.add(itempath, recursive=False)
-                elif os.path.isdir(itempath):
-                    if os.listdir(itempath) == []:
-                        tar.add(itempath)
-                    else:
-                        self.tar_add_folder(tar, itempath)
+                if item.is_symlink():
+                    entries.append((item.path, BACKUP_LINK, 0, 0))
+                elif item.is_dir(follow_symlinks=False):
+                    if item.stat(follow_symlinks=False).st_dev != device:
+                        entries.append((item.path, BACKUP_MOUNT, 0, 0))
+                        continue
+                    count = len(entries)
+                    total_size += self.scan_backup_folder(item.path, device, entries, rules, saved)
+                    if len(entries) == count:
+                        entries.append((item.path, BACKUP_DIR, 0, 0))
                 else:
-                    self.done_backup_size += os.path.getsize(itempath)
-                    tar.add(itempath)
-                    if hasattr(self, 'backup_dlg'):
-                        progress = round(1.0 * self.done_backup_size / self.total_backup_size * 100)
-                        self.backup_dlg.update(int(progress), f'{folder}\n{item}')
-        finally:
-            self.backup_dlg.close()
+                    stat = item.stat(follow_symlinks=False)
+                    entries.append((item.path, BACKUP_FILE, stat.st_size, stat.st_mtime_ns))
+                    total_size += stat.st_size
+            except OSError as e:
+                log.log(f'{item.path}: {repr(e)}', log.WARNING)
+        return total_size
 
-    @log.log_function()
-    def get_folder_size(self, folder):
-        for item in os.listdir(folder):
-            itempath = os.path.join(folder, item)
-            if os.path.islink(itempath):
-                continue
-            elif os.path.isfile(itempath):
-                self.total_backup_size += os.path.getsize(itempath)
-            elif os.path.ismount(itempath):
-                continue
-            elif os.path.isdir(itempath):
-                self.get_folder_size(itempath)
+    def count_excluded(self, item, device, stats):
+        if item.is_symlink():
+            return
+        if item.is_dir(follow_symlinks=False):
+            excluded = []
+            stats[0] += self.scan_backup_folder(item.path, device, excluded)
+            stats[1] += sum(1 for entry in excluded if entry[1] == BACKUP_FILE)
+        else:
+            stats[0] += item.stat(follow_symlinks=False).st_size
+            stats[1] += 1
 
     @log.log_function()
     def init_pinlock(self, listItem=None):
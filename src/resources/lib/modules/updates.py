@@ -8,6 +8,8 @@ import modules
 import os
 import re
 import glob
+import hashlib
+import random
 import time
 import json
 import xbmc
@@ -26,9 +28,18 @@ class updates(modules.Module):
 
     ENABLED = False
     KERNEL_CMD = None
+    RPI_FLASHING_TRIGGER = None
+    RPI_EEPROM_CACHE = None
+    RPI_EEPROM_FIRMWARE = None
     UPDATE_REQUEST_URL = None
     UPDATE_DOWNLOAD_URL = None
     LOCAL_UPDATE_DIR = None
+    STAGING_UPDATE_DIR = None
+    UPDATE_CHECK_INTERVAL = None
+    UPDATE_CHECK_JITTER = None
+    UPDATE_PENDING_INTERVAL = None
+    UPDATE_RETRY_MIN = None
+    UPDATE_RETRY_MAX = None
     menu = {'2': {
         'name': 32005,
         'menuLoader': 'load_menu',
@@ -44,6 +55,14 @@ class updates(modules.Module):
         self.nox_keyboard_layouts = False
         self.last_update_check = 0
         self.arrVariants = {}
+        self.loaded = threading.Event()
+        self.loading_struct = {
+            'loading': {
+                'order': 1,
+                'name': 32401,
+                'settings': {},
+                },
+            }
         self.struct = {
             'update': {
                 'order': 1,
@@ -147,6 +166,19 @@ class updates(modules.Module):
                         'InfoText': 770,
                         'order': 9,
                         },
+                    'UpdateBandwidth': {
+                        'name': 32402,
+                        'value': '0',
+                        'action': 'set_value',
+                        'type': 'multivalue',
+                        'values': ['0', '128', '256', '512', '1024', '2048', '4096'],
+                        'parent': {
+                            'entry': 'AutoUpdate',
+                            'value': ['auto'],
+                            },
+                        'InfoText': 32403,
+                        'order': 10,
+                        },
                     },
                 },
             'rpieeprom': {
@@ -176,13 +208,40 @@ class updates(modules.Module):
     def start_service(self):
         try:
             self.oe.dbg_log('updates::start_service', 'enter_function', self.oe.LOGDEBUG)
+            self.loaded.clear()
+            self.load_thread = threading.Thread(target=self.load_values_async, daemon=True)
+            self.load_thread.start()
+            self.oe.dbg_log('updates::start_service', 'exit_function', self.oe.LOGDEBUG)
+        except Exception as e:
+            self.oe.dbg_log('updates::start_service', f'ERROR: ({repr(e)})')
+
+    # Runs on its own thread so network fetches and hardware probing do not
+    # hold up the remaining modules and the service socket at boot
+    def load_values_async(self):
+        try:
+            self.oe.dbg_log('updates::load_values_async', 'enter_function', self.oe.LOGDEBUG)
             self.is_service = True
             self.load_values()
+            self.loaded.set()
+            self.refresh_menu()
             self.set_auto_update()
             del self.is_service
-            self.oe.dbg_log('updates::start_service', 'exit_function', self.oe.LOGDEBUG)
+            self.oe.dbg_log('updates::load_values_async', 'exit_function', self.oe.LOGDEBUG)
         except Exception as e:
-            self.oe.dbg_log('updates::start_service', f'ERROR: ({repr(e)})')
+            self.loaded.set()
+            self.oe.dbg_log('updates::load_values_async', f'ERROR: ({repr(e)})')
+
+    def refresh_menu(self):
+        try:
+            self.oe.dbg_log('updates::refresh_menu', 'enter_function', self.oe.LOGDEBUG)
+            if hasattr(self.oe, 'winOeMain') and self.oe.winOeMain.visible:
+                selectedMenuItem = self.oe.winOeMain.getControl(self.oe.winOeMain.guiMenList).getSelectedItem()
+                if selectedMenuItem.getProperty('modul') == 'updates':
+                    self.oe.winOeMain.lastMenu = -1
+                    self.oe.winOeMain.onFocus(self.oe.winOeMain.guiMenList)
+            self.oe.dbg_log('updates::refresh_menu', 'exit_function', self.oe.LOGDEBUG)
+        except Exception as e:
+            self.oe.dbg_log('updates::refresh_menu', f'ERROR: ({repr(e)})')
 
     def stop_service(self):
         try:
@@ -288,8 +347,17 @@ class updates(modules.Module):
             value = self.oe.read_setting('updates', 'UpdateNotify')
             if not value is None:
                 self.struct['update']['settings']['UpdateNotify']['value'] = value
+            value = self.oe.read_setting('updates', 'UpdateBandwidth')
+            if not value is None:
+                self.struct['update']['settings']['UpdateBandwidth']['value'] = value
             if os.path.isfile(f'{self.LOCAL_UPDATE_DIR}/SYSTEM'):
                 self.update_in_progress = True
+            value = self.oe.read_setting('updates', 'last_update_check')
+            if not value is None:
+                try:
+                    self.last_update_check = float(value)
+                except ValueError:
+                    self.last_update_check = 0
 
             # Manual Update
 
@@ -318,13 +386,7 @@ class updates(modules.Module):
             # RPi4 EEPROM updating
             if self.oe.RPI_CPU_VER == '3':
                 self.rpi_flashing_state = self.get_rpi_flashing_state()
-                if self.rpi_flashing_state['incompatible']:
-                    self.struct['rpieeprom']['hidden'] = 'true'
-                else:
-                    self.struct['rpieeprom']['settings']['bootloader']['value'] = self.get_rpi_eeprom('BOOTLOADER')
-                    self.struct['rpieeprom']['settings']['bootloader']['name'] = f"{self.oe._(32024)} ({self.rpi_flashing_state['bootloader']['state']})"
-                    self.struct['rpieeprom']['settings']['vl805']['value'] = self.get_rpi_eeprom('VL805')
-                    self.struct['rpieeprom']['settings']['vl805']['name'] = f"{self.oe._(32026)} ({self.rpi_flashing_state['vl805']['state']})"
+                self.set_rpi_struct()
             else:
                 self.struct['rpieeprom']['hidden'] = 'true'
 
@@ -336,7 +398,10 @@ class updates(modules.Module):
     def load_menu(self, focusItem):
         try:
             self.oe.dbg_log('updates::load_menu', 'enter_function', self.oe.LOGDEBUG)
-            self.oe.winOeMain.build_menu(self.struct)
+            if self.loaded.is_set():
+                self.oe.winOeMain.build_menu(self.struct)
+            else:
+                self.oe.winOeMain.build_menu(self.loading_struct)
             self.oe.dbg_log('updates::load_menu', 'exit_function', self.oe.LOGDEBUG)
         except Exception as e:
             self.oe.dbg_log('updates::load_menu', f'ERROR: ({repr(e)})')
@@ -545,6 +610,7 @@ class updates(modules.Module):
             if update_json != '':
                 update_json = json.loads(update_json)
                 self.last_update_check = time.time()
+                self.oe.write_setting('updates', 'last_update_check', str(int(self.last_update_check)))
                 if 'update' in update_json['data'] and 'folder' in update_json['data']:
                     self.update_file = self.UPDATE_DOWNLOAD_URL % (update_json['data']['folder'], update_json['data']['update'])
                     if self.struct['update']['settings']['UpdateNotify']['value'] == '1':
@@ -556,18 +622,35 @@ class updates(modules.Module):
         except Exception as e:
             self.oe.dbg_log('updates::check_updates_v2', f'ERROR: ({repr(e)})')
 
+    def get_next_update_check(self):
+        if hasattr(self, 'update_thread'):
+            return self.update_thread.next_run
+        return None
+
+    def get_update_state(self):
+        return {
+            'channel': self.struct['update']['settings']['Channel']['value'],
+            'auto_update': self.struct['update']['settings']['AutoUpdate']['value'],
+            'available': getattr(self, 'update_file', '').split('/')[-1] or None,
+            'in_progress': hasattr(self, 'update_in_progress'),
+            'last_check': self.last_update_check or None,
+            'next_check': self.get_next_update_check(),
+            'channels': sorted(getattr(self, 'update_json', None) or []),
+            }
+
     def do_autoupdate(self, listItem=None, silent=False):
         try:
             self.oe.dbg_log('updates::do_autoupdate', 'enter_function', self.oe.LOGDEBUG)
             if hasattr(self, 'update_file'):
                 if not os.path.exists(self.LOCAL_UPDATE_DIR):
                     os.makedirs(self.LOCAL_UPDATE_DIR)
-                downloaded = self.oe.download_file(self.update_file, self.oe.TEMP + 'update_file', silent)
+                downloaded = self.stage_update(self.update_file, silent)
                 if not downloaded is None:
                     self.update_file = self.update_file.split('/')[-1]
                     if self.struct['update']['settings']['UpdateNotify']['value'] == '1':
                         self.oe.notify(self.oe._(32363), self.oe._(32366))
-                    shutil.move(self.oe.TEMP + 'update_file', self.LOCAL_UPDATE_DIR + self.update_file)
+                    shutil.move(downloaded, self.LOCAL_UPDATE_DIR + self.update_file)
+                    self.clear_staged_update()
                     subprocess.call('sync', shell=True, stdin=None, stdout=None, stderr=None)
                     if silent == False:
                         self.oe.winOeMain.close()
@@ -580,30 +663,175 @@ class updates(modules.Module):
         except Exception as e:
             self.oe.dbg_log('updates::do_autoupdate', f'ERROR: ({repr(e)})')
 
-    def get_rpi_flashing_state(self):
+    # Downloads into a persistent staging area. Silent (automatic) downloads are
+    # throttled to the configured bandwidth and pause during playback; partial
+    # files are resumed across restarts as long as the source url is unchanged.
+    def stage_update(self, url, silent=False):
         try:
-            self.oe.dbg_log('updates::get_rpi_flashing_state', 'enter_function', self.oe.LOGDEBUG)
+            self.oe.dbg_log('updates::stage_update', 'enter_function', self.oe.LOGDEBUG)
+            staged_file = f'{self.STAGING_UPDATE_DIR}update_file'
+            state_file = f'{self.STAGING_UPDATE_DIR}update_file.json'
+            if not os.path.exists(self.STAGING_UPDATE_DIR):
+                os.makedirs(self.STAGING_UPDATE_DIR)
+            state = {}
+            if os.path.isfile(state_file):
+                with open(state_file, 'r') as f:
+                    state = json.load(f)
+            if state.get('url') != url:
+                self.clear_staged_update()
+                with open(state_file, 'w') as f:
+                    json.dump({'url': url}, f)
+            max_rate = 0
+            pause = None
+            if silent:
+                max_rate = int(self.struct['update']['settings']['UpdateBandwidth']['value'] or 0) * 1024
+                pause = xbmc.Player().isPlaying
+            downloaded = self.oe.download_file(url, staged_file, silent, resume=True, max_rate=max_rate, pause=pause)
+            if not downloaded is None and not self.verify_update(url, downloaded):
+                self.clear_staged_update()
+                downloaded = None
+            self.oe.dbg_log('updates::stage_update', 'exit_function', self.oe.LOGDEBUG)
+            return downloaded
+        except Exception as e:
+            self.oe.dbg_log('updates::stage_update', f'ERROR: ({repr(e)})')
 
-            jdata = {
-                        'EXITCODE': 'EXIT_FAILED',
-                        'BOOTLOADER_CURRENT': 0, 'BOOTLOADER_LATEST': 0,
-                        'VL805_CURRENT': '', 'VL805_LATEST': ''
-                    }
+    def verify_update(self, url, path):
+        try:
+            self.oe.dbg_log('updates::verify_update', 'enter_function', self.oe.LOGDEBUG)
+            checksum = self.oe.load_url(f'{url}.sha256')
+            if not checksum:
+                self.oe.dbg_log('updates::verify_update', f'no checksum published for {url}', self.oe.LOGWARNING)
+                return True
+            expected = checksum.split()[0].lower()
+            sha256 = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(1048576), b''):
+                    sha256.update(chunk)
+            result = sha256.hexdigest() == expected
+            if not result:
+                self.oe.dbg_log('updates::verify_update', f'checksum mismatch for {url}', self.oe.LOGERROR)
+            self.oe.dbg_log('updates::verify_update', 'exit_function', self.oe.LOGDEBUG)
+            return result
+        except Exception as e:
+            self.oe.dbg_log('updates::verify_update', f'ERROR: ({repr(e)})')
+            return False
 
-            state = {
+    def clear_staged_update(self):
+        for name in ['update_file', 'update_file.json']:
+            if os.path.exists(f'{self.STAGING_UPDATE_DIR}{name}'):
+                os.remove(f'{self.STAGING_UPDATE_DIR}{name}')
+
+    def set_rpi_struct(self):
+        if self.rpi_flashing_state['incompatible']:
+            self.struct['rpieeprom']['hidden'] = 'true'
+        else:
+            if 'hidden' in self.struct['rpieeprom']:
+                del self.struct['rpieeprom']['hidden']
+            self.struct['rpieeprom']['settings']['bootloader']['value'] = self.get_rpi_eeprom('BOOTLOADER')
+            self.struct['rpieeprom']['settings']['bootloader']['name'] = f"{self.oe._(32024)} ({self.rpi_flashing_state['bootloader']['state']})"
+            self.struct['rpieeprom']['settings']['vl805']['value'] = self.get_rpi_eeprom('VL805')
+            self.struct['rpieeprom']['settings']['vl805']['name'] = f"{self.oe._(32026)} ({self.rpi_flashing_state['vl805']['state']})"
+
+    # The eeprom tool output only changes after a reboot or a firmware update,
+    # so its result is cached keyed by boot_id and the firmware files mtime
+    def get_rpi_eeprom_cache_key(self):
+        boot_id = self.oe.load_file('/proc/sys/kernel/random/boot_id')
+        mtime = 0
+        for path in self.RPI_EEPROM_FIRMWARE:
+            for root, dirs, files in os.walk(path):
+                for name in files:
+                    try:
+                        mtime = max(mtime, os.stat(os.path.join(root, name)).st_mtime)
+                    except OSError:
+                        pass
+        return f'{boot_id}:{mtime}'
+
+    def load_rpi_eeprom_cache(self):
+        try:
+            with open(self.RPI_EEPROM_CACHE, 'r') as cache_file:
+                return json.load(cache_file)
+        except (OSError, ValueError):
+            return None
+
+    def clear_rpi_eeprom_cache(self):
+        if os.path.exists(self.RPI_EEPROM_CACHE):
+            os.remove(self.RPI_EEPROM_CACHE)
+
+    def query_rpi_eeprom(self, key):
+        try:
+            self.oe.dbg_log('updates::query_rpi_eeprom', 'enter_function', self.oe.LOGDEBUG)
+
+            cache = {
+                        'key': key,
                         'incompatible': True,
-                        'bootloader': {'state': '', 'current': 'unknown', 'latest': 'unknown'},
-                        'vl805': {'state': '', 'current': 'unknown', 'latest': 'unknown'}
+                        'jdata': {
+                            'EXITCODE': 'EXIT_FAILED',
+                            'BOOTLOADER_CURRENT': 0, 'BOOTLOADER_LATEST': 0,
+                            'VL805_CURRENT': '', 'VL805_LATEST': ''
+                        }
                     }
 
             with tempfile.NamedTemporaryFile(mode='r', delete=True) as machine_out:
                 console_output = self.oe.execute(f'/usr/bin/.rpi-eeprom-update.real -j -m "{machine_out.name}"', get_result=1).split('\n')
                 if os.path.getsize(machine_out.name) != 0:
-                    state['incompatible'] = False
-                    jdata = json.load(machine_out)
+                    cache['incompatible'] = False
+                    cache['jdata'] = json.load(machine_out)
+
+            self.oe.dbg_log('updates::query_rpi_eeprom', f'console output: {console_output}', self.oe.LOGDEBUG)
+
+            if not os.path.exists(os.path.dirname(self.RPI_EEPROM_CACHE)):
+                os.makedirs(os.path.dirname(self.RPI_EEPROM_CACHE))
+            with open(f'{self.RPI_EEPROM_CACHE}.tmp', 'w') as cache_file:
+                json.dump(cache, cache_file)
+            os.replace(f'{self.RPI_EEPROM_CACHE}.tmp', self.RPI_EEPROM_CACHE)
+
+            self.oe.dbg_log('updates::query_rpi_eeprom', 'exit_function', self.oe.LOGDEBUG)
+            return cache
+        except Exception as e:
+            self.oe.dbg_log('updates::query_rpi_eeprom', f'ERROR: ({repr(e)})')
+
+    def refresh_rpi_flashing_state(self, key):
+        try:
+            self.oe.dbg_log('updates::refresh_rpi_flashing_state', 'enter_function', self.oe.LOGDEBUG)
+            cache = self.query_rpi_eeprom(key)
+            if not cache is None:
+                self.rpi_flashing_state = self.build_rpi_flashing_state(cache)
+                self.set_rpi_struct()
+                self.refresh_menu()
+            self.oe.dbg_log('updates::refresh_rpi_flashing_state', 'exit_function', self.oe.LOGDEBUG)
+        except Exception as e:
+            self.oe.dbg_log('updates::refresh_rpi_flashing_state', f'ERROR: ({repr(e)})')
+
+    def get_rpi_flashing_state(self):
+        try:
+            self.oe.dbg_log('updates::get_rpi_flashing_state', 'enter_function', self.oe.LOGDEBUG)
+            key = self.get_rpi_eeprom_cache_key()
+            cache = self.load_rpi_eeprom_cache()
+            if cache is None:
+                cache = self.query_rpi_eeprom(key)
+            elif cache.get('key') != key:
+                # serve the stale state now, the menu is refreshed once the tool has run
+                self.oe.dbg_log('updates::get_rpi_flashing_state', 'cache is stale, refreshing', self.oe.LOGDEBUG)
+                threading.Thread(target=self.refresh_rpi_flashing_state, args=(key,), daemon=True).start()
+            self.oe.dbg_log('updates::get_rpi_flashing_state', 'exit_function', self.oe.LOGDEBUG)
+            return self.build_rpi_flashing_state(cache)
+        except Exception as e:
+            self.oe.dbg_log('updates::get_rpi_flashing_state', f'ERROR: ({repr(e)})')
+            return {'incompatible': True}
+
+    def build_rpi_flashing_state(self, cache):
+        try:
+            self.oe.dbg_log('updates::build_rpi_flashing_state', 'enter_function', self.oe.LOGDEBUG)
+
+            jdata = cache['jdata']
+
+            state = {
+                        'incompatible': cache['incompatible'],
+                        'bootloader': {'state': '', 'current': 'unknown', 'latest': 'unknown'},
+                        'vl805': {'state': '', 'current': 'unknown', 'latest': 'unknown'}
+                    }
 
-            self.oe.dbg_log('updates::get_rpi_flashing_state', f'console output: {console_output}', self.oe.LOGDEBUG)
-            self.oe.dbg_log('updates::get_rpi_flashing_state', f'json values: {jdata}', self.oe.LOGDEBUG)
+            self.oe.dbg_log('updates::build_rpi_flashing_state', f'json values: {jdata}', self.oe.LOGDEBUG)
 
             if jdata['BOOTLOADER_CURRENT'] != 0:
                 state['bootloader']['current'] = datetime.datetime.utcfromtimestamp(jdata['BOOTLOADER_CURRENT']).strftime('%Y-%m-%d')
@@ -628,11 +856,11 @@ class updates(modules.Module):
                 else:
                     state['vl805']['state'] = self.oe._(32029) % state['vl805']['current']
 
-            self.oe.dbg_log('updates::get_rpi_flashing_state', f'state: {state}', self.oe.LOGDEBUG)
-            self.oe.dbg_log('updates::get_rpi_flashing_state', 'exit_function', self.oe.LOGDEBUG)
+            self.oe.dbg_log('updates::build_rpi_flashing_state', f'state: {state}', self.oe.LOGDEBUG)
+            self.oe.dbg_log('updates::build_rpi_flashing_state', 'exit_function', self.oe.LOGDEBUG)
             return state
         except Exception as e:
-            self.oe.dbg_log('updates::get_rpi_flashing_state', f'ERROR: ({repr(e)})')
+            self.oe.dbg_log('updates::build_rpi_flashing_state', f'ERROR: ({repr(e)})')
             return {'incompatible': True}
 
     def get_rpi_eeprom(self, device):
@@ -663,6 +891,7 @@ class updates(modules.Module):
             else:
                 if os.path.exists(self.RPI_FLASHING_TRIGGER):
                     os.remove(self.RPI_FLASHING_TRIGGER)
+            self.clear_rpi_eeprom_cache()
 
             self.oe.dbg_log('updates::set_rpi_eeprom', 'exit_function', self.oe.LOGDEBUG)
         except Exception as e:
@@ -702,6 +931,8 @@ class updateThread(threading.Thread):
             self.oe = oeMain
             self.stopped = False
             self.wait_evt = threading.Event()
+            self.next_run = 0
+            self.retry_delay = 0
             threading.Thread.__init__(self)
             self.oe.dbg_log('updates::updateThread', 'Started', self.oe.LOGINFO)
             self.oe.dbg_log('updates::updateThread::__init__', 'exit_function', self.oe.LOGDEBUG)
@@ -717,18 +948,46 @@ class updateThread(threading.Thread):
         except Exception as e:
             self.oe.dbg_log('updates::updateThread::stop()', f'ERROR: ({repr(e)})')
 
+    def schedule(self, delay):
+        self.next_run = time.time() + delay
+        self.oe.dbg_log('updates::updateThread::schedule', f'next check at {time.ctime(self.next_run)}', self.oe.LOGINFO)
+
+    # First run after start: honour the persisted last check so restarts do not
+    # reset the period, and spread overdue checks over the jitter window so a
+    # fleet of boxes booting together does not hit the server at once
+    def schedule_first(self, updates):
+        due = updates.last_update_check + updates.UPDATE_CHECK_INTERVAL - time.time()
+        jitter = random.uniform(0, updates.UPDATE_CHECK_JITTER)
+        if due <= 0:
+            self.schedule(jitter)
+        else:
+            self.schedule(due + jitter)
+
     def run(self):
         try:
             self.oe.dbg_log('updates::updateThread::run', 'enter_function', self.oe.LOGDEBUG)
+            updates = self.oe.dictModules['updates']
+            self.schedule_first(updates)
             while self.stopped == False:
-                if not xbmc.Player().isPlaying():
-                    self.oe.dictModules['updates'].check_updates_v2()
-                if not hasattr(self.oe.dictModules['updates'], 'update_in_progress'):
-                    self.wait_evt.wait(21600)
+                self.wait_evt.wait(max(self.next_run - time.time(), 0))
+                triggered = self.wait_evt.is_set()
+                self.wait_evt.clear()
+                if self.stopped:
+                    break
+                if not triggered and time.time() < self.next_run:
+                    continue
+                if xbmc.Player().isPlaying():
+                    self.retry_delay = min(max(self.retry_delay * 2, updates.UPDATE_RETRY_MIN), updates.UPDATE_RETRY_MAX)
+                    self.oe.dbg_log('updates::updateThread::run', f'Playback active, retrying in {self.retry_delay}s', self.oe.LOGDEBUG)
+                    self.schedule(self.retry_delay)
+                    continue
+                self.retry_delay = 0
+                updates.check_updates_v2()
+                if not hasattr(updates, 'update_in_progress'):
+                    self.schedule(updates.UPDATE_CHECK_INTERVAL + random.uniform(0, updates.UPDATE_CHECK_JITTER))
                 else:
                     self.oe.notify(self.oe._(32363), self.oe._(32364))
-                    self.wait_evt.wait(3600)
-                self.wait_evt.clear()
+                    self.schedule(updates.UPDATE_PENDING_INTERVAL)
             self.oe.dbg_log('updates::updateThread', 'Stopped', self.oe.LOGINFO)
             self.oe.dbg_log('updates::updateThread::run', 'exit_function', self.oe.LOGDEBUG)
         except Exception as e:
@@ -11,16 +11,22 @@ import xbmcgui
 import xbmcvfs
 import os
 import re
+import contextlib
 import locale
 import sys
-import urllib.request, urllib.error, urllib.parse
+import urllib.parse
+import threading
 import time
 import tarfile
-import traceback
 import subprocess
 import dbus
 import dbus.mainloop.glib
 import defaults
+import dbus_systemd
+import http_client
+import log
+import modules
+import service_config
 import shutil
 import hashlib, binascii
 
@@ -40,10 +46,15 @@ xbmcDialog = xbmcgui.Dialog()
 xbmcm = xbmc.Monitor()
 
 is_service = False
-conf_lock = False
+# held across every read-modify-write of the settings file, which the
+# window, the update thread and the settings socket all write
+conf_lock = threading.RLock()
 xbmcIsPlaying = 0
 input_request = False
 dictModules = {}
+START_WORKERS = 4
+# called with (module, setting, value) after write_setting saved a value
+setting_hooks = []
 listObject = {
     'list': 1100,
     'netlist': 1200,
@@ -218,6 +229,10 @@ class ProgressDialog:
     def setSize(self, total_size):
         self.total_size = total_size
 
+    def setOffset(self, offset):
+        self.partial_size = offset
+        self.prev_size = offset
+
     def getPercent(self):
         return self.percent
 
@@ -297,13 +312,10 @@ def _(code):
 
 
 def dbg_log(source, text, level=LOGERROR):
-    if level == LOGDEBUG and os.environ.get('DEBUG', 'no') == 'no':
+    if level == LOGDEBUG and not log.DEBUG_ENV or not log.enabled(level):
         return
-    xbmc.log(f"## LibreELEC Addon ## {source} ## {text}", level)
-    if level == LOGERROR:
-        tracedata = traceback.format_exc()
-        if tracedata != "NoneType: None\n":
-            xbmc.log(tracedata, level)
+    if log.write(f"## LibreELEC Addon ## {source} ## {text}", level) and level == LOGERROR:
+        log.write_exception(level)
 
 def notify(title, message, icon='icon'):
     try:
@@ -347,49 +359,21 @@ def enable_service(service):
 
 def set_service_option(service, option, value):
     try:
-        lines = []
-        changed = False
-        conf_file_name = f'{CONFIG_CACHE}/services/{service}.conf'
-        if os.path.isfile(conf_file_name):
-            with open(conf_file_name, 'r') as conf_file:
-                for line in conf_file:
-                    if option in line:
-                        line = f'{option}={value}'
-                        changed = True
-                    lines.append(line.strip())
-        if changed == False:
-            lines.append(f'{option}={value}')
-        with open(conf_file_name, 'w') as conf_file:
-            conf_file.write('\n'.join(lines) + '\n')
+        service_config.set_option(service, option, value)
     except Exception as e:
         dbg_log('oe::set_service_option', f'ERROR: ({repr(e)})')
 
 
 def get_service_option(service, option, default=None):
     try:
-        lines = []
-        conf_file_name = ''
-        if os.path.exists(f'{CONFIG_CACHE}/services/{service}.conf'):
-            conf_file_name = f'{CONFIG_CACHE}/services/{service}.conf'
-        if os.path.exists(f'{CONFIG_CACHE}/services/{service}.disabled'):
-            conf_file_name = f'{CONFIG_CACHE}/services/{service}.disabled'
-        if os.path.exists(conf_file_name):
-            with open(conf_file_name, 'r') as conf_file:
-                for line in conf_file:
-                    if option in line:
-                        if '=' in line:
-                            default = line.strip().split('=')[-1]
-        return default
+        return service_config.get_option(service, option, default)
     except Exception as e:
         dbg_log('oe::get_service_option', f'ERROR: ({repr(e)})')
 
 
 def get_service_state(service):
     try:
-        if os.path.exists(f'{CONFIG_CACHE}/services/{service}.conf'):
-            return '1'
-        else:
-            return '0'
+        return service_config.get_state(service)
     except Exception as e:
         dbg_log('oe::get_service_state', f'ERROR: ({repr(e)})')
 
@@ -400,43 +384,54 @@ def set_service(service, options, state):
         dbg_log('oe::set_service::service', repr(service), LOGDEBUG)
         dbg_log('oe::set_service::options', repr(options), LOGDEBUG)
         dbg_log('oe::set_service::state', repr(state), LOGDEBUG)
-        config = {}
-        changed = False
+        options = {option: str(value) for option, value in options.items()}
+        old_state = service_config.get_state(service)
+        old_options = service_config.get_options(service)
+        new_state = '1' if state == 1 else '0'
+        conf_file = service_config.conf_file(service)
+        disabled_file = service_config.disabled_file(service)
 
         # Service Enabled
 
-        if state == 1:
-
-            # Is Service alwys enabled ?
-
-            if get_service_state(service) == '1':
-                cfn = f'{CONFIG_CACHE}/services/{service}.conf'
-                cfo = cfn
-            else:
-                cfn = f'{CONFIG_CACHE}/services/{service}.conf'
-                cfo = f'{CONFIG_CACHE}/services/{service}.disabled'
-            if os.path.exists(cfo) and not cfo == cfn:
-                os.remove(cfo)
-            with open(cfn, 'w') as cf:
-                for option in options:
-                    cf.write(f'{option}={options[option]}\n')
+        if new_state == '1':
+            if old_state != '1' or old_options != options:
+                service_config.write(conf_file, options)
+            if os.path.exists(disabled_file):
+                os.remove(disabled_file)
         else:
 
         # Service Disabled
 
-            cfo = f'{CONFIG_CACHE}/services/{service}.conf'
-            cfn = f'{CONFIG_CACHE}/services/{service}.disabled'
-            if os.path.exists(cfo):
-                os.rename(cfo, cfn)
+            if os.path.exists(conf_file):
+                os.rename(conf_file, disabled_file)
+                service_config.forget(conf_file)
+        jobs = None
         if not __oe__.is_service:
-            if service in defaults._services:
-                for svc in defaults._services[service]:
-                    execute(f'systemctl restart {svc}')
+            units = changed_units(service, old_state, new_state, old_options, options)
+            if units and new_state == '1':
+                jobs = dbus_systemd.restart_units(units)
+            elif units:
+                jobs = dbus_systemd.stop_units(units)
         dbg_log('oe::set_service', 'exit_function', LOGDEBUG)
+        return jobs
     except Exception as e:
         dbg_log('oe::set_service', f'ERROR: ({repr(e)})')
 
 
+# units of a service that have to be restarted: all of them when the service
+# is switched on or off, otherwise only those reading a changed option
+def changed_units(service, old_state, new_state, old_options, new_options):
+    units = defaults._services.get(service, [])
+    if old_state != new_state:
+        return list(units)
+    if new_state == '0':
+        return []
+    changed = {option for option in old_options.keys() | new_options.keys() if old_options.get(option) != new_options.get(option)}
+    if not changed:
+        return []
+    return [unit for unit in units if not unit in defaults._services_options or changed & set(defaults._services_options[unit])]
+
+
 def load_file(filename):
     try:
         if os.path.isfile(filename):
@@ -449,35 +444,87 @@ def load_file(filename):
     except Exception as e:
         dbg_log(f'oe::load_file({filename})', f'ERROR: ({repr(e)})')
 
+# write through a temporary file next to the resolved target and rename it
+# over the target, so readers never see a partially written file
+@contextlib.contextmanager
+def atomic_write(filename, mode='w'):
+    filename = os.path.realpath(filename)
+    temp_filename = f'{filename}.tmp'
+    try:
+        with open(temp_filename, mode) as objFile:
+            yield objFile
+            objFile.flush()
+            os.fsync(objFile.fileno())
+        os.replace(temp_filename, filename)
+    except BaseException:
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(temp_filename)
+        raise
+
 def url_quote(var):
     return urllib.parse.quote(var, safe="")
 
 def load_url(url):
     try:
-        request = urllib.request.Request(url)
-        response = urllib.request.urlopen(request)
-        content = response.read()
+        content = http_client.get(url)
         return content.decode('utf-8').strip()
     except Exception as e:
         dbg_log(f'oe::load_url({url})', f'ERROR: ({repr(e)})')
 
 
-def download_file(source, destination, silent=False):
+def open_url(source, offset=0):
+    response = http_client.request(urllib.parse.quote(source, safe=':/'), offset=offset)
+    if offset > 0 and response.status != 206:
+        offset = 0
+    return (response, offset)
+
+
+def download_file(source, destination, silent=False, resume=False, max_rate=0, pause=None):
     try:
-        local_file = open(destination, 'wb')
+        offset = 0
+        if resume and os.path.isfile(destination):
+            offset = os.path.getsize(destination)
+
+        try:
+            response, offset = open_url(source, offset)
+        except http_client.HTTPError as e:
+            # Requested range starts at the end of the file: nothing left to fetch
+            if e.code == 416 and offset > 0:
+                return destination
+            raise
 
-        response = urllib.request.urlopen(urllib.parse.quote(source, safe=':/'))
+        local_file = open(destination, 'ab' if offset > 0 else 'wb')
 
         progress = ProgressDialog()
         if not silent:
             progress.open()
 
         progress.setSource(source)
-        progress.setSize(int(response.getheader('Content-Length').strip()))
+        progress.setSize(offset + int(response.getheader('Content-Length').strip()))
+        progress.setOffset(offset)
 
         last_percent = 0
+        rate_start = time.time()
+        rate_size = 0
 
         while not (progress.iscanceled() or xbmcm.abortRequested()):
+            if pause is not None and pause():
+                dbg_log(f'oe::download_file({destination})', 'paused', LOGINFO)
+                response.close()
+                while pause() and not xbmcm.abortRequested():
+                    xbmcm.waitForAbort(5)
+                if xbmcm.abortRequested():
+                    break
+                dbg_log(f'oe::download_file({destination})', 'resumed', LOGINFO)
+                local_file.flush()
+                response, offset = open_url(source, local_file.tell())
+                if offset == 0:
+                    local_file.seek(0)
+                    local_file.truncate()
+                    progress.setOffset(0)
+                rate_start = time.time()
+                rate_size = 0
+
             part = response.read(32768)
 
             progress.sample(part)
@@ -491,6 +538,11 @@ def download_file(source, destination, silent=False):
 
             if part:
                 local_file.write(part)
+                if max_rate > 0:
+                    rate_size += len(part)
+                    delay = rate_size / max_rate - (time.time() - rate_start)
+                    if delay > 0:
+                        xbmcm.waitForAbort(delay)
             else:
                 break
 
@@ -499,7 +551,12 @@ def download_file(source, destination, silent=False):
         response.close()
 
         if progress.iscanceled() or xbmcm.abortRequested():
-            os.remove(destination)
+            if not resume:
+                os.remove(destination)
+            return None
+
+        if os.path.getsize(destination) != progress.total_size:
+            dbg_log(f'oe::download_file({destination})', f'incomplete download: {os.path.getsize(destination)} of {progress.total_size} bytes')
             return None
 
         return destination
@@ -559,15 +616,31 @@ def start_service():
     global dictModules, __oe__
     try:
         __oe__.is_service = True
+        start_modules = {}
         for strModule in sorted(dictModules, key=lambda x: list(dictModules[x].menu.keys())):
             module = dictModules[strModule]
             if hasattr(module, 'start_service') and module.ENABLED:
-                module.start_service()
-        __oe__.is_service = False
+                start_modules[strModule] = module
+        runner = modules.Runner(start_modules, 'start_service', 'START_DEPENDS', 'START_TIMEOUT', START_WORKERS)
+        runner.start()
+        runner.join()
+        dbg_log('oe::start_service', runner.report(), LOGINFO)
+        if runner.timed_out:
+            threading.Thread(target=end_service_mode, args=(runner,), daemon=True).start()
+        else:
+            __oe__.is_service = False
     except Exception as e:
         dbg_log('oe::start_service', f'ERROR: ({repr(e)})')
 
 
+# a module given up on is still starting, its set_service calls must not
+# restart units either, so service mode ends once it returned
+def end_service_mode(runner):
+    runner.all_finished.wait()
+    dbg_log('oe::start_service', runner.report(), LOGINFO)
+    __oe__.is_service = False
+
+
 def stop_service():
     global dictModules
     try:
@@ -575,6 +648,8 @@ def stop_service():
             module = dictModules[strModule]
             if hasattr(module, 'stop_service') and module.ENABLED:
                 module.stop_service()
+        http_client.close_all()
+        log.dump_timings()
         xbmc.log('## LibreELEC Addon ## STOP SERVICE DONE !')
     except Exception as e:
         dbg_log('oe::stop_service', f'ERROR: ({repr(e)})')
@@ -590,7 +665,7 @@ def openWizard():
         dbg_log('oe::openWizard', f'ERROR: ({repr(e)})')
 
 
-def openConfigurationWindow():
+def openConfigurationWindow(page=None):
     global winOeMain, __cwd__, __oe__, dictModules, PIN
     try:
         match = True
@@ -625,7 +700,7 @@ def openConfigurationWindow():
               return
 
         if match == True:
-            winOeMain = oeWindows.mainWindow('service-LibreELEC-Settings-mainWindow.xml', __cwd__, 'Default', oeMain=__oe__)
+            winOeMain = oeWindows.mainWindow('service-LibreELEC-Settings-mainWindow.xml', __cwd__, 'Default', oeMain=__oe__, page=page)
             winOeMain.doModal()
             for strModule in dictModules:
                 dictModules[strModule].exit()
@@ -645,16 +720,13 @@ def standby_devices():
 
 def load_config():
     try:
-        global conf_lock
-        while conf_lock:
-            time.sleep(0.2)
-        conf_lock = True
-        if os.path.exists(configFile):
-            config_file = open(configFile, 'r')
-            config_text = config_file.read()
-            config_file.close()
-        else:
-            config_text = ''
+        with conf_lock:
+            if os.path.exists(configFile):
+                config_file = open(configFile, 'r')
+                config_text = config_file.read()
+                config_file.close()
+            else:
+                config_text = ''
         if config_text == '':
             xml_conf = minidom.Document()
             xml_main = xml_conf.createElement('libreelec')
@@ -666,7 +738,6 @@ def load_config():
             config_text = xml_conf.toprettyxml()
         else:
             xml_conf = minidom.parseString(config_text)
-        conf_lock = False
         return xml_conf
     except Exception as e:
         dbg_log('oe::load_config', f'ERROR: ({repr(e)})')
@@ -674,14 +745,11 @@ def load_config():
 
 def save_config(xml_conf):
     try:
-        global configFile, conf_lock
-        while conf_lock:
-            time.sleep(0.2)
-        conf_lock = True
-        config_file = open(configFile, 'w')
-        config_file.write(xml_conf.toprettyxml())
-        config_file.close()
-        conf_lock = False
+        global configFile
+        with conf_lock:
+            config_file = open(configFile, 'w')
+            config_file.write(xml_conf.toprettyxml())
+            config_file.close()
     except Exception as e:
         dbg_log('oe::save_config', f'ERROR: ({repr(e)})')
 
@@ -720,11 +788,12 @@ def read_node(node_name):
 
 def remove_node(node_name):
     try:
-        xml_conf = load_config()
-        xml_node = xml_conf.getElementsByTagName(node_name)
-        for xml_main_node in xml_node:
-            xml_main_node.parentNode.removeChild(xml_main_node)
-        save_config(xml_conf)
+        with conf_lock:
+            xml_conf = load_config()
+            xml_node = xml_conf.getElementsByTagName(node_name)
+            for xml_main_node in xml_node:
+                xml_main_node.parentNode.removeChild(xml_main_node)
+            save_config(xml_conf)
     except Exception as e:
         dbg_log('oe::remove_node', f'ERROR: ({repr(e)})')
 
@@ -746,35 +815,38 @@ def read_setting(module, setting, default=None):
 
 def write_setting(module, setting, value, main_node='settings'):
     try:
-        xml_conf = load_config()
-        xml_settings = xml_conf.getElementsByTagName(main_node)
-        if len(xml_settings) == 0:
-            for xml_main in xml_conf.getElementsByTagName('libreelec'):
-                xml_sub = xml_conf.createElement(main_node)
-                xml_main.appendChild(xml_sub)
-                xml_settings = xml_conf.getElementsByTagName(main_node)
-        module_found = 0
-        setting_found = 0
-        for xml_setting in xml_settings:
-            for xml_modul in xml_setting.getElementsByTagName(module):
-                module_found = 1
-                for xml_modul_setting in xml_modul.getElementsByTagName(setting):
-                    setting_found = 1
-        if setting_found == 1:
-            if hasattr(xml_modul_setting.firstChild, 'nodeValue'):
-                xml_modul_setting.firstChild.nodeValue = value
+        with conf_lock:
+            xml_conf = load_config()
+            xml_settings = xml_conf.getElementsByTagName(main_node)
+            if len(xml_settings) == 0:
+                for xml_main in xml_conf.getElementsByTagName('libreelec'):
+                    xml_sub = xml_conf.createElement(main_node)
+                    xml_main.appendChild(xml_sub)
+                    xml_settings = xml_conf.getElementsByTagName(main_node)
+            module_found = 0
+            setting_found = 0
+            for xml_setting in xml_settings:
+                for xml_modul in xml_setting.getElementsByTagName(module):
+                    module_found = 1
+                    for xml_modul_setting in xml_modul.getElementsByTagName(setting):
+                        setting_found = 1
+            if setting_found == 1:
+                if hasattr(xml_modul_setting.firstChild, 'nodeValue'):
+                    xml_modul_setting.firstChild.nodeValue = value
+                else:
+                    xml_value = xml_conf.createTextNode(value)
+                    xml_modul_setting.appendChild(xml_value)
             else:
+                if module_found == 0:
+                    xml_modul = xml_conf.createElement(module)
+                    xml_setting.appendChild(xml_modul)
+                xml_setting = xml_conf.createElement(setting)
+                xml_modul.appendChild(xml_setting)
                 xml_value = xml_conf.createTextNode(value)
-                xml_modul_setting.appendChild(xml_value)
-        else:
-            if module_found == 0:
-                xml_modul = xml_conf.createElement(module)
-                xml_setting.appendChild(xml_modul)
-            xml_setting = xml_conf.createElement(setting)
-            xml_modul.appendChild(xml_setting)
-            xml_value = xml_conf.createTextNode(value)
-            xml_setting.appendChild(xml_value)
-        save_config(xml_conf)
+                xml_setting.appendChild(xml_value)
+            save_config(xml_conf)
+        for hook in setting_hooks:
+            hook(module, setting, value)
     except Exception as e:
         dbg_log('oe::write_setting', f'ERROR: ({repr(e)})')
 
@@ -3,6 +3,7 @@
 # Copyright (C) 2013 Lutz Fiebach (lufie@openelec.tv)
 # Copyright (C) 2019-present Team LibreELEC (https://libreelec.tv)
 
+import modules
 import oe
 import xbmc
 import xbmcgui
@@ -26,6 +27,9 @@ prevModule = ""
 
 class mainWindow(xbmcgui.WindowXMLDialog):
 
+    INIT_WORKERS = 4
+    INIT_TIMEOUT = 10
+
     def __init__(self, *args, **kwargs):
         self.visible = False
         self.lastMenu = -1
@@ -59,6 +63,12 @@ class mainWindow(xbmcgui.WindowXMLDialog):
         self.lastListType = -1
         if 'isChild' in kwargs:
             self.isChild = True
+        self.page = kwargs.get('page')
+        self.menuPage = None
+        self.menuKeys = []
+        self.menuItems = []
+        self.menuState = []
+        self.labels = {}
         pass
 
     def onInit(self):
@@ -73,12 +83,10 @@ class mainWindow(xbmcgui.WindowXMLDialog):
             self.setProperty('version', oe.VERSION)
             self.setProperty('build', oe.BUILD)
             oe.winOeMain = self
+            self.start_init()
             for strModule in sorted(oe.dictModules, key=lambda x: list(oe.dictModules[x].menu.keys())):
                 module = oe.dictModules[strModule]
-                oe.dbg_log('init module', strModule, oe.LOGDEBUG)
                 if module.ENABLED:
-                    if hasattr(module, 'do_init'):
-                        Thread(target=module.do_init(), args=()).start()
                     for men in module.menu:
                         if 'listTyp' in module.menu[men] and 'menuLoader' in module.menu[men]:
                             dictProperties = {
@@ -89,11 +97,47 @@ class mainWindow(xbmcgui.WindowXMLDialog):
                             if 'InfoText' in module.menu[men]:
                                 dictProperties['InfoText'] = oe._(module.menu[men]['InfoText'])
                             self.addMenuItem(module.menu[men]['name'], dictProperties)
+            if self.page:
+                self.select_page(self.page)
             self.setFocusId(self.guiMenList)
             self.onFocus(self.guiMenList)
         except Exception as e:
             oe.dbg_log('oeWindows.mainWindow::onInit', f'ERROR: ({repr(e)})')
 
+    # module do_init runs on a worker pool while the menu is already shown,
+    # a page waits for its module in onFocus
+    def start_init(self):
+        init_modules = {}
+        for strModule in sorted(oe.dictModules, key=lambda x: list(oe.dictModules[x].menu.keys())):
+            module = oe.dictModules[strModule]
+            if module.ENABLED and hasattr(module, 'do_init'):
+                oe.dbg_log('init module', strModule, oe.LOGDEBUG)
+                init_modules[strModule] = module
+        self.init_runner = modules.Runner(init_modules, 'do_init', 'INIT_DEPENDS', self.INIT_WORKERS)
+        self.init_runner.start()
+        Thread(target=self.report_init, daemon=True).start()
+
+    def report_init(self):
+        for strModule in self.init_runner.modules:
+            self.init_runner.wait(strModule)
+        oe.dbg_log('oeWindows.mainWindow::onInit', self.init_runner.report(), oe.LOGINFO)
+
+    def wait_module(self, strModule):
+        if hasattr(self, 'init_runner') and not self.init_runner.is_ready(strModule):
+            xbmc.executebuiltin('ActivateWindow(busydialognocancel)')
+            try:
+                self.init_runner.wait(strModule, self.INIT_TIMEOUT)
+            finally:
+                xbmc.executebuiltin('Dialog.Close(busydialognocancel)')
+
+    # select the first menu entry of a module, e.g. 'connman' or 'system'
+    def select_page(self, page):
+        menu = self.getControl(self.guiMenList)
+        for index in range(menu.size()):
+            if menu.getListItem(index).getProperty('modul') == page:
+                menu.selectItem(index)
+                return
+
     def addMenuItem(self, strName, dictProperties):
         try:
             lstItem = xbmcgui.ListItem(label=oe._(strName))
@@ -115,15 +159,14 @@ class mainWindow(xbmcgui.WindowXMLDialog):
 
     def build_menu(self, struct, fltr=[], optional='0'):
         try:
-            self.getControl(1100).reset()
             m_menu = []
             for category in sorted(struct, key=lambda x: struct[x]['order']):
                 if not 'hidden' in struct[category]:
                     if fltr == []:
                         m_entry = {}
-                        m_entry['name'] = oe._(struct[category]['name'])
+                        m_entry['key'] = (category, None)
+                        m_entry['name'] = self.label(struct[category]['name'])
                         m_entry['properties'] = {'typ': 'separator'}
-                        m_entry['list'] = 1100
                         m_menu.append(m_entry)
                     else:
                         if category not in fltr:
@@ -132,41 +175,68 @@ class mainWindow(xbmcgui.WindowXMLDialog):
                         setting = struct[category]['settings'][entry]
                         if not 'hidden' in setting:
                             dictProperties = {
-                                'value': setting['value'],
-                                'typ': setting['type'],
+                                'value': str(setting['value']),
+                                'typ': str(setting['type']),
                                 'entry': entry,
                                 'category': category,
-                                'action': setting['action'],
+                                'action': str(setting['action']),
                                 }
                             if 'InfoText' in setting:
-                                dictProperties['InfoText'] = oe._(setting['InfoText'])
+                                dictProperties['InfoText'] = self.label(setting['InfoText'])
                             if 'validate' in setting:
-                                dictProperties['validate'] = setting['validate']
+                                dictProperties['validate'] = str(setting['validate'])
                             if 'values' in setting:
                                 dictProperties['values'] = '|'.join(setting['values'])
                             if isinstance(setting['name'], str):
                                 name = setting['name']
                             else:
-                                name = oe._(setting['name'])
-                                dictProperties['menuname'] = oe._(setting['name'])
+                                name = self.label(setting['name'])
+                                dictProperties['menuname'] = name
                             m_entry = {}
                             if not 'parent' in setting:
+                                m_entry['key'] = (category, entry)
                                 m_entry['name'] = name
                                 m_entry['properties'] = dictProperties
-                                m_entry['list'] = 1100
                                 m_menu.append(m_entry)
                             else:
                                 if struct[category]['settings'][setting['parent']['entry']]['value'] in setting['parent']['value']:
                                     if not 'optional' in setting or 'optional' in setting and optional != '0':
+                                        m_entry['key'] = (category, entry)
                                         m_entry['name'] = name
                                         m_entry['properties'] = dictProperties
-                                        m_entry['list'] = 1100
                                         m_menu.append(m_entry)
-            for m_entry in m_menu:
-                self.addConfigItem(m_entry['name'], m_entry['properties'], m_entry['list'])
+            # the key only tells pages apart, show_menu finds what changed
+            self.show_menu((id(struct), tuple(fltr), optional), m_menu)
         except Exception as e:
             oe.dbg_log('oeWindows.mainWindow::build_menu', f'ERROR: ({repr(e)})')
 
+    # the list items of the page shown last are kept: when a page is built
+    # again with the same entries, only labels and properties that differ
+    # from the list item are set; onClick changes the value on the item
+    def show_menu(self, page, m_menu):
+        keys = [m_entry['key'] for m_entry in m_menu]
+        if page != self.menuPage or keys != self.menuKeys or None in self.menuItems:
+            self.getControl(self.guiList).reset()
+            self.menuItems = [self.addConfigItem(m_entry['name'], m_entry['properties'], self.guiList) for m_entry in m_menu]
+        else:
+            for lstItem, m_entry, strProps in zip(self.menuItems, m_menu, self.menuState):
+                if lstItem.getLabel() != m_entry['name']:
+                    lstItem.setLabel(m_entry['name'])
+                for strProp, value in m_entry['properties'].items():
+                    if lstItem.getProperty(strProp) != str(value):
+                        lstItem.setProperty(strProp, str(value))
+                for strProp in strProps - m_entry['properties'].keys():
+                    lstItem.setProperty(strProp, '')
+        self.menuPage = page
+        self.menuKeys = keys
+        self.menuState = [set(m_entry['properties']) for m_entry in m_menu]
+
+    # localized strings do not change while the window is open
+    def label(self, code):
+        if not code in self.labels:
+            self.labels[code] = oe._(code)
+        return self.labels[code]
+
     def showButton(self, number, name, module, action, onup=None, onleft=None):
         try:
             oe.dbg_log('oeWindows::showButton', 'enter_function', oe.LOGDEBUG)
@@ -374,8 +444,12 @@ class mainWindow(xbmcgui.WindowXMLDialog):
                     objList = self.getControl(int(selectedMenuItem.getProperty('listTyp')))
                     self.getControl(controlID).controlRight(objList)
                     if strMenuLoader != '':
-                        if hasattr(oe.dictModules[selectedMenuItem.getProperty('modul')], strMenuLoader):
-                            getattr(oe.dictModules[selectedMenuItem.getProperty('modul')], strMenuLoader)(selectedMenuItem)
+                        self.wait_module(selectedMenuItem.getProperty('modul'))
+                        module = oe.dictModules[selectedMenuItem.getProperty('modul')]
+                        if hasattr(module, 'load_page'):
+                            module.load_page()
+                        if hasattr(module, strMenuLoader):
+                            getattr(module, strMenuLoader)(selectedMenuItem)
                     self.getControl(int(selectedMenuItem.getProperty('listTyp'))).setAnimations([('conditional',
                             'effect=fade start=0 end=100 time=100 condition=true')])
         except Exception as e:
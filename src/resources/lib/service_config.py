@@ -0,0 +1,87 @@
+# SPDX-License-Identifier: GPL-2.0
+# Copyright (C) 2020-present Team LibreELEC
+import defaults
+import os
+import threading
+
+SERVICES_DIR = f'{defaults.CONFIG_CACHE}/services'
+
+_CACHE = {}
+_LOCK = threading.Lock()
+
+
+def conf_file(service):
+    return f'{SERVICES_DIR}/{service}.conf'
+
+
+def disabled_file(service):
+    return f'{SERVICES_DIR}/{service}.disabled'
+
+
+def parse(lines):
+    options = {}
+    for line in lines:
+        key, separator, value = line.strip().partition('=')
+        if separator and key and not key.startswith('#'):
+            options[key.strip()] = value.strip()
+    return options
+
+
+# options of a file, parsed once and cached until its mtime or size changes;
+# a missing file has no options
+def read(file_name):
+    try:
+        stat = os.stat(file_name)
+    except FileNotFoundError:
+        with _LOCK:
+            _CACHE.pop(file_name, None)
+        return {}
+    key = (stat.st_mtime_ns, stat.st_size)
+    with _LOCK:
+        cached = _CACHE.get(file_name)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+    with open(file_name, 'r') as config_file:
+        options = parse(config_file)
+    with _LOCK:
+        _CACHE[file_name] = (key, options)
+    return options
+
+
+def forget(file_name):
+    with _LOCK:
+        _CACHE.pop(file_name, None)
+
+
+# a disabled service keeps its options in <service>.disabled
+def active_file(service):
+    if os.path.exists(disabled_file(service)):
+        return disabled_file(service)
+    return conf_file(service)
+
+
+def get_options(service):
+    return dict(read(active_file(service)))
+
+
+def get_option(service, option, default=None):
+    return read(active_file(service)).get(option, default)
+
+
+def get_state(service):
+    return '1' if os.path.exists(conf_file(service)) else '0'
+
+
+def write(file_name, options):
+    temp_file = f'{file_name}.tmp'
+    with open(temp_file, 'w') as config_file:
+        for option, value in options.items():
+            config_file.write(f'{option}={value}\n')
+    os.replace(temp_file, file_name)
+    forget(file_name)
+
+
+def set_option(service, option, value):
+    options = dict(read(conf_file(service)))
+    options[option] = value
+    write(conf_file(service), options)
@@ -4,98 +4,273 @@
 # Copyright (C) 2019-present Team LibreELEC (https://libreelec.tv)
 
 import syspath
+import asyncio
+import dbus_utils
+import json
 import oe
 import os
 import log
+import shlex
 import threading
-import socket
+import time
 import xbmc
 
 
-class Service_Thread(threading.Thread):
+# commands of the settings socket, a request is one line in either form:
+#   get system hostname         answered with "OK <result>" or "ERROR <message>"
+#   {"command": "get", "args": ["system", "hostname"], "id": 1}
+#                               answered with {"result": ...} or {"error": ...}
+# handlers run on a worker thread, results are sent as JSON unless they are
+# a string on the plain form
+COMMANDS = {}
+
+
+def command(name):
+    def register(function):
+        COMMANDS[name] = function
+        return function
+    return register
+
+
+class Service_Thread(object):
 
     SOCKET = '/var/run/service.libreelec.settings.sock'
+    LINE_LIMIT = 64 * 1024
 
     def __init__(self):
-        threading.Thread.__init__(self)
-        self.init()
+        self.server = None
 
     @log.log_function()
-    def init(self):
+    def start(self):
+        if oe.read_setting('libreelec', 'wizard_completed') == None:
+            threading.Thread(target=oe.openWizard).start()
+        asyncio.run_coroutine_threadsafe(self.serve(), dbus_utils.LOOP).result()
+
+    async def serve(self):
         if os.path.exists(self.SOCKET):
             os.remove(self.SOCKET)
-        self.daemon = True
-        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        self.sock.setblocking(1)
-        self.sock.bind(self.SOCKET)
-        self.sock.listen(1)
-        self.stopped = False
+        self.server = await asyncio.start_unix_server(self.handle_client, path=self.SOCKET, limit=self.LINE_LIMIT)
 
-    @log.log_function()
-    def run(self):
-        if oe.read_setting('libreelec', 'wizard_completed') == None:
-            threading.Thread(target=oe.openWizard).start()
-        while self.stopped == False:
-            log.log(f'Waiting', log.INFO)
-            conn, addr = self.sock.accept()
-            message = (conn.recv(1024)).decode('utf-8')
-            conn.close()
-            log.log(f'Received {message}', log.INFO)
-            if message == 'openConfigurationWindow':
-                if not hasattr(oe, 'winOeMain'):
-                    threading.Thread(target=oe.openConfigurationWindow).start()
-                else:
-                    if oe.winOeMain.visible != True:
-                        threading.Thread(
-                            target=oe.openConfigurationWindow).start()
-            if message == 'exit':
-                self.stopped = True
+    # a client can send any number of requests on one connection, a request
+    # without the final newline is still handled when the client closes
+    async def handle_client(self, reader, writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                reply = await self.handle_request(line.decode('utf-8', 'replace').strip())
+                writer.write(f'{reply}\n'.encode('utf-8'))
+                await writer.drain()
+        except (ConnectionError, ValueError) as e:
+            log.log(f'Client dropped: {repr(e)}', log.WARNING)
+        finally:
+            writer.close()
+
+    async def handle_request(self, request):
+        if request.startswith('{'):
+            return await self.handle_json_request(request)
+        try:
+            args = shlex.split(request)
+        except ValueError as e:
+            return f'ERROR {e}'
+        if not args:
+            return 'ERROR empty request'
+        try:
+            result = await self.run_command(args[0], args[1:])
+        except Exception as e:
+            return f'ERROR {e}'
+        if result is None:
+            return 'OK'
+        if isinstance(result, str):
+            return f'OK {result}'
+        return f'OK {json.dumps(result, default=str)}'
+
+    async def handle_json_request(self, request):
+        reply = {}
+        try:
+            message = json.loads(request)
+            if 'id' in message:
+                reply['id'] = message['id']
+            args = message.get('args', [])
+            if not isinstance(args, list):
+                raise ValueError('args must be a list')
+            reply['result'] = await self.run_command(str(message.get('command')), args)
+        except Exception as e:
+            reply['error'] = str(e)
+        return json.dumps(reply, default=str)
+
+    async def run_command(self, name, args):
+        log.log(f'Received {name} {args}', log.INFO)
+        handler = COMMANDS.get(name)
+        if handler is None:
+            raise ValueError(f'unknown command {name}')
+        try:
+            return await asyncio.get_running_loop().run_in_executor(None, handler, self, *args)
+        except TypeError as e:
+            raise ValueError(f'{name}: {e}')
+        except Exception as e:
+            log.log(f'{name}: {repr(e)}', log.ERROR)
+            raise ValueError(f'{name}: {repr(e)}')
+
+    @command('help')
+    def list_commands(self):
+        return ' '.join(sorted(COMMANDS))
+
+    @command('openConfigurationWindow')
+    @command('open')
+    def open_window(self, page=None):
+        if not hasattr(oe, 'winOeMain') or oe.winOeMain.visible != True:
+            threading.Thread(target=oe.openConfigurationWindow, args=(page,)).start()
+
+    @command('get')
+    def get_setting(self, module, setting):
+        value = oe.read_setting(module, setting)
+        return '' if value is None else value
+
+    @command('set')
+    def set_setting(self, module, setting, value, category=None):
+        if module not in oe.dictModules:
+            raise ValueError(f'unknown module {module}')
+        oe.dictModules[module].apply_setting(setting, value, category)
+
+    @command('services')
+    def list_services(self):
+        return oe.dictModules['connman'].get_services_state()
+
+    @command('bluetooth_devices')
+    def list_bluetooth_devices(self):
+        return oe.dictModules['bluetooth'].get_devices_state()
+
+    @command('update_status')
+    def update_status(self):
+        return oe.dictModules['updates'].get_update_state()
+
+    @command('check_update')
+    def check_update(self):
+        updates = oe.dictModules['updates']
+        updates.check_updates_v2(force=True)
+        return getattr(updates, 'update_file', '').split('/')[-1]
+
+    # write a backup into folder with the saved backup settings, answered
+    # with the archive path once it is complete
+    @command('backup')
+    def backup(self, folder):
+        if not os.path.isdir(folder):
+            raise ValueError(f'{folder} is not a folder')
+        return oe.dictModules['system'].write_backup(folder)
+
+    # "timing on" and "timing off" switch the recording of the call times of
+    # logged functions, "timing" writes them to log.TIMING_FILE, sorted by
+    # their slowest p95, and is answered with the file name
+    @command('timing')
+    def timing(self, state=None):
+        if state is not None:
+            if not state in ('on', 'off'):
+                raise ValueError('timing takes on or off')
+            log.enable_timing(state == 'on')
+            return
+        file_name = log.dump_timings()
+        if file_name is None:
+            raise ValueError('timing is off or nothing was timed yet')
+        return file_name
 
     @log.log_function()
     def stop(self):
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        sock.connect(self.SOCKET)
-        sock.send(bytes('exit', 'utf-8'))
-        sock.close()
-        self.join()
-        self.sock.close()
+        asyncio.run_coroutine_threadsafe(self.close(), dbus_utils.LOOP).result()
+
+    async def close(self):
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+        if os.path.exists(self.SOCKET):
+            os.remove(self.SOCKET)
+
+
+# bluetooth standby after the idle timeout: the settings are read once and
+# again only when write_setting changes them, the timer is armed for the
+# moment the timeout can be reached at the earliest and re-armed for the
+# rest of it when the user was active in between
+class Idle_Timer(object):
+
+    MIN_TIMEOUT = 60
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.timer = None
+        self.stopped = False
+        self.standby_period = None
+        self.load_settings()
+
+    def load_settings(self):
+        self.standby = oe.read_setting('bluetooth', 'standby')
+        try:
+            self.timeout = int(oe.read_setting('bluetooth', 'idle_timeout')) * 60
+        except (TypeError, ValueError):
+            self.timeout = 0
+
+    def setting_written(self, module, setting, value):
+        if module == 'bluetooth' and setting in ('standby', 'idle_timeout'):
+            self.load_settings()
+            self.arm()
+
+    def arm(self, delay=None):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+            if self.stopped or not self.standby or self.timeout < self.MIN_TIMEOUT:
+                return
+            if delay is None:
+                delay = max(self.timeout - xbmc.getGlobalIdleTime(), 0)
+            self.timer = threading.Timer(delay, self.check)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def check(self):
+        idle = xbmc.getGlobalIdleTime()
+        if idle < self.timeout:
+            self.arm(self.timeout - idle)
+            return
+        # one standby per idle period, the period is identified by its start
+        period = int(time.time() - idle)
+        if self.standby_period is None or abs(period - self.standby_period) > 2:
+            self.standby_period = period
+            log.log(f'Idle timeout reached', log.DEBUG)
+            oe.standby_devices()
+        self.arm(self.timeout)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
 
 
 class Monitor(xbmc.Monitor):
 
     @log.log_function()
     def onScreensaverActivated(self):
-        if oe.read_setting('bluetooth', 'standby'):
+        if self.idle_timer.standby:
             threading.Thread(target=oe.standby_devices).start()
 
     @log.log_function()
     def onDPMSActivated(self):
-        if oe.read_setting('bluetooth', 'standby'):
+        if self.idle_timer.standby:
             threading.Thread(target=oe.standby_devices).start()
 
     @log.log_function()
     def run(self):
+        self.idle_timer = Idle_Timer()
+        oe.setting_hooks.append(self.idle_timer.setting_written)
         oe.load_modules()
         oe.start_service()
+        self.idle_timer.arm()
         service_thread = Service_Thread()
         service_thread.start()
-        while not self.abortRequested():
-            if self.waitForAbort(60):
-                break
-            if not oe.read_setting('bluetooth', 'standby'):
-                continue
-            timeout = oe.read_setting('bluetooth', 'idle_timeout')
-            if not timeout:
-                continue
-            try:
-                timeout = int(timeout)
-            except:
-                continue
-            if timeout < 1:
-                continue
-            if xbmc.getGlobalIdleTime() / 60 >= timeout:
-                log.log(f'Idle timeout reached', log.DEBUG)
-                oe.standby_devices()
+        self.waitForAbort()
+        self.idle_timer.stop()
         if hasattr(oe, 'winOeMain') and hasattr(oe.winOeMain, 'visible'):
             if oe.winOeMain.visible == True:
                 oe.winOeMain.close()
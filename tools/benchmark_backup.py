@@ -0,0 +1,100 @@
+# SPDX-License-Identifier: GPL-2.0
+# Copyright (C) 2020-present Team LibreELEC
+#
+# time backup.create() and backup.validate() for every available compression
+# on a generated Kodi userdata tree, or on the folders given
+#   python3 tools/benchmark_backup.py
+#   python3 tools/benchmark_backup.py /storage/.kodi [more folders...]
+
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'resources', 'lib'))
+import backup
+
+
+# settings XML, a video database and thumbnails the way a Kodi userdata
+# folder holds them: many small text files, one large compressible file and
+# many incompressible binaries; the same tree is generated on every run
+def synthetic_tree(folder, addons=150, movies=20000, thumbnails=600):
+    rng = random.Random(0)
+    userdata = os.path.join(folder, '.kodi', 'userdata')
+    os.makedirs(os.path.join(userdata, 'Database'))
+    with open(os.path.join(userdata, 'guisettings.xml'), 'w') as xml_file:
+        xml_file.write('<settings version="2">\n')
+        for index in range(2000):
+            xml_file.write(f'    <setting id="section.setting{index}">{rng.randrange(1000)}</setting>\n')
+        xml_file.write('</settings>\n')
+    for index in range(addons):
+        addon_data = os.path.join(userdata, 'addon_data', f'plugin.video.addon{index}')
+        os.makedirs(addon_data)
+        with open(os.path.join(addon_data, 'settings.xml'), 'w') as xml_file:
+            xml_file.write('<settings version="2">\n')
+            for setting in range(rng.randrange(5, 60)):
+                xml_file.write(f'    <setting id="option{setting}">{rng.getrandbits(32):x}</setting>\n')
+            xml_file.write('</settings>\n')
+    database = sqlite3.connect(os.path.join(userdata, 'Database', 'MyVideos121.db'))
+    database.execute('CREATE TABLE movie (idMovie INTEGER PRIMARY KEY, title TEXT, plot TEXT, path TEXT, rating REAL)')
+    words = ['the', 'a', 'man', 'woman', 'city', 'night', 'last', 'war', 'love', 'story', 'return', 'of', 'dark', 'house']
+    database.executemany('INSERT INTO movie VALUES (?, ?, ?, ?, ?)', (
+        (index, ' '.join(rng.choices(words, k=3)), ' '.join(rng.choices(words, k=60)),
+         f'smb://nas/movies/{index:05}/movie.mkv', rng.random() * 10) for index in range(movies)))
+    database.commit()
+    database.close()
+    for index in range(thumbnails):
+        name = f'{rng.getrandbits(32):08x}'
+        thumbnail_folder = os.path.join(userdata, 'Thumbnails', name[0])
+        os.makedirs(thumbnail_folder, exist_ok=True)
+        with open(os.path.join(thumbnail_folder, f'{name}.jpg'), 'wb') as thumbnail:
+            thumbnail.write(rng.randbytes(rng.randrange(10000, 200000)))
+    return [os.path.join(folder, '.kodi')]
+
+
+def files(folders):
+    for folder in folders:
+        for root, dirs, names in os.walk(folder):
+            for name in names:
+                path = os.path.join(root, name)
+                if os.path.isfile(path) and not os.path.islink(path):
+                    yield path
+
+
+def main(folders):
+    with tempfile.TemporaryDirectory() as temp:
+        if not folders:
+            folders = synthetic_tree(os.path.join(temp, 'storage'))
+        paths = list(files(folders))
+        total = sum(os.path.getsize(path) for path in paths)
+        print(f'{len(paths)} files, {backup.format_size(total)}, default {backup.default_mode()}')
+        for mode in backup.available_modes():
+            archive = os.path.join(temp, backup.archive_name('20000101000000', mode))
+            manifest = backup.new_manifest(archive)
+            started = time.perf_counter()
+            with backup.create(archive, mode) as tar:
+                for path in paths:
+                    size, mtime, digest = backup.add_file(tar, path)
+                    manifest['files'][path] = [size, mtime, digest, manifest['archive']]
+            backup.write_manifest(archive, manifest)
+            created = time.perf_counter() - started
+            started = time.perf_counter()
+            backup.validate(archive)
+            validated = time.perf_counter() - started
+            staged = ''
+            if not mode in backup.BOOT_MODES:
+                started = time.perf_counter()
+                backup.stage(archive, os.path.join(temp, 'staged.tar'))
+                staged = f', staging {time.perf_counter() - started:.2f}s'
+                os.remove(os.path.join(temp, 'staged.tar'))
+            size = os.path.getsize(archive)
+            print(f'{mode:5} {created:6.2f}s create, {validated:6.2f}s validate{staged}, '
+                  f'{backup.format_size(size)} ({size * 100 // max(total, 1)}%)')
+            os.remove(archive)
+            os.remove(backup.manifest_path(archive))
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])